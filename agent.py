@@ -6,20 +6,121 @@ permissions and authentication.
 
 import asyncio
 import json
+from collections import defaultdict, deque
+from uuid import uuid4
 
 from base import InternalMessagingServer
-from settings import MAX_PACKET_SIZE
+from lod import NetworkLOD
+from protocol import FrameDecoder, ProtocolError, decode_batch, \
+    decode_enter, encode_frame
+from schema import peek_fields
+from settings import MAX_PACKET_SIZE, SEND_QUEUE_HIGH_WATER, \
+    SEND_QUEUE_LOW_WATER, SEND_QUEUE_LIMIT
 from util import Channel
 
+# What to do with a client whose send queue passes the high water mark
+DROP_SUPERSEDED = "drop"  # Shed queued updates that newer ones replace
+KICK = "kick"  # Disconnect it
+
+
+class _Queued:
+    """One frame waiting in a client's send queue."""
+    __slots__ = ('frame', 'object_id', 'fields')
+
+    def __init__(self, frame: bytes, object_id=None, fields=0):
+        self.frame = frame  # None once it's been dropped
+        self.object_id = object_id  # Only set for updates
+        self.fields = fields
+
 
 class ClientConnection:
     """Represents all the data pertaining to one client."""
-    def __init__(self, r, w):
+    # The most bytes handed to the socket at once
+    batch_size = 64 * 1024
+
+    def __init__(self, r, w, decoder: FrameDecoder, policy=DROP_SUPERSEDED,
+                 high_water=SEND_QUEUE_HIGH_WATER,
+                 low_water=SEND_QUEUE_LOW_WATER, limit=SEND_QUEUE_LIMIT):
         # The client connection should not read or write data if it has no id
         # (except for authentication)
         self.id = None
         self.reader, self.writer = r, w
-        self.subscriptions = []
+        self.decoder = decoder
+        self.subscriptions = set()
+        # (when, zone it came from, zone it entered, frame) of recent enters
+        # not sent because we were watching the zone it came from
+        self.skipped_enters = deque()
+
+        # Outbound frames wait here until the socket has room for them
+        self.policy = policy
+        self.high_water, self.low_water, self.limit = \
+            high_water, low_water, limit
+        self.closed = False
+        self.behind = False
+        self.queued_bytes = 0
+        self._queue = deque()
+        self._latest_update = {}  # object id -> its newest queued update
+        self._ready = asyncio.Event()
+        self._sender = None
+
+    def start_sending(self, loop):
+        self._sender = asyncio.ensure_future(self._send_queued(), loop=loop)
+
+    def send(self, frame: bytes, update: tuple=None):
+        """Queue a frame for this client without waiting for the socket. Pass
+        the (object id, fields) of update frames, from schema.peek_fields, so
+        a newer update for the same object can replace them if the client
+        falls behind.
+        """
+        if self.closed:
+            return
+        entry = _Queued(frame)
+        if update is not None:
+            entry.object_id, entry.fields = update
+            previous = self._latest_update.get(entry.object_id)
+            self._latest_update[entry.object_id] = entry
+            # An update carrying every field of the last one supersedes it
+            if self.behind and previous is not None and \
+                    previous.frame is not None and \
+                    previous.fields & ~entry.fields == 0:
+                self.queued_bytes -= len(previous.frame)
+                previous.frame = None
+
+        self._queue.append(entry)
+        self.queued_bytes += len(frame)
+        self._ready.set()
+
+        if self.queued_bytes > self.limit:
+            self.kick()
+        elif self.queued_bytes > self.high_water:
+            self.behind = True
+            if self.policy == KICK:
+                self.kick()
+
+    async def _send_queued(self):
+        """Hand queued frames to the socket whenever it has drained."""
+        while not self.closed:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._queue and not self.closed:
+                batch, size = [], 0
+                while self._queue and size < self.batch_size:
+                    entry = self._queue.popleft()
+                    if entry.object_id is not None and \
+                            self._latest_update.get(entry.object_id) is entry:
+                        del self._latest_update[entry.object_id]
+                    if entry.frame is None:
+                        continue  # Superseded
+                    batch.append(entry.frame)
+                    size += len(entry.frame)
+                self.queued_bytes -= size
+                if self.queued_bytes <= self.low_water:
+                    self.behind = False
+                try:
+                    self.writer.write(b"".join(batch))
+                    await self.writer.drain()
+                except ConnectionError:
+                    self.kick()
 
     def responds_to(self, channel: Channel) -> bool:
         """Return whether or not the client is listening to this channel."""
@@ -30,8 +131,17 @@ class ClientConnection:
         return channel.target in self.subscriptions
 
     def kick(self):
-        """Terminate this client connection."""
-        pass  # TODO: Implement me! We need an easy way to kick a client.
+        """Terminate this client connection. The agent notices the socket
+        closing and cleans up after it.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._latest_update.clear()
+        self.queued_bytes = 0
+        self._ready.set()  # Let the sender task finish
+        self.writer.close()
 
     def __repr__(self):
         host, port = self.writer.get_extra_info('peername')
@@ -44,20 +154,117 @@ class PastryAgent(InternalMessagingServer):
 
     On one side a secure TCP socket talks to the client, and on the other side
     a Redis pubsub connection speaks with the entire internal network.
+
+    Set reuse_port to run several agent processes on the same host and port,
+    for example Supervisor(MyZone, *[MyAgent] * 4). The kernel spreads new
+    connections between them, and each keeps its own routes and Redis
+    subscriptions.
     """
     _loop = None
-    connections = []
     finished = False
+    registry = None
+
+    # Where clients connect
+    host = '127.0.0.1'
+    port = 8888
+    reuse_port = False
+
+    # How to treat clients that can't keep up; see ClientConnection
+    slow_client_policy = DROP_SUPERSEDED
+    send_queue_high_water = SEND_QUEUE_HIGH_WATER
+    send_queue_low_water = SEND_QUEUE_LOW_WATER
+    send_queue_limit = SEND_QUEUE_LIMIT
+
+    # Network level of detail (see lod.py): updates for objects farther than
+    # each distance from a client's avatar go out at most once per that many
+    # seconds, e.g. ((20, 0), (100, 0.25), (None, 1)). Off when empty.
+    lod_tiers = ()
+    lod_position_fields = ("x", "y")
+    lod_tick_rate = 20  # How often held updates are checked, in Hz
+
+    # Enters aren't sent to clients watching the zone the object came from,
+    # since the update moving it reached them there. A client that leaves
+    # that zone within this many seconds gets them after all, in case its
+    # leave crossed the update and it dropped the object.
+    enter_grace = 2.0
+
+    def __init__(self, loop=None, transport=None):
+        super().__init__(loop=loop, transport=transport)
+        # Whispers for any of this agent's users arrive here and are routed
+        # by user id, so there's no internal subscription per user.
+        self.inbox = "agent-{}".format(uuid4().hex)
+        self.internal_subscribe(self.inbox)
+        self.connections = []
+        # Which connections each zone or user channel is delivered to. For
+        # zones, the size of each set doubles as the reference count of the
+        # internal subscription: it's made for the first connection and
+        # dropped with the last.
+        self.routes = defaultdict(set)  # target -> {ClientConnection, ...}
+        # Targets subscribed on behalf of connections (not the agent itself)
+        self._routed_channels = set()
+        self.lod = None
+        if self.lod_tiers:
+            self.lod = NetworkLOD(self.registry, self.lod_tiers,
+                                  self.lod_position_fields)
+        self._lod_task = None
+
+    def _route(self, target: str, connection: ClientConnection,
+               subscribe=True):
+        if subscribe and target not in self.routes and \
+                target not in self.channels:
+            self.internal_subscribe(target)
+            self._routed_channels.add(target)
+        self.routes[target].add(connection)
+        if self.lod:
+            self.lod.watch(target)
+
+    def _unroute(self, target: str, connection: ClientConnection):
+        connections = self.routes.get(target)
+        if connections is None:
+            return
+        connections.discard(connection)
+        if self.lod:
+            self.lod.leave(connection, target)
+        if not connections:
+            del self.routes[target]
+            if self.lod:
+                self.lod.unwatch(target)
+            if target in self._routed_channels:
+                self._routed_channels.remove(target)
+                self.internal_unsubscribe(target)
+
+    def _forget(self, connection: ClientConnection):
+        """Stop routing anything to a connection. Safe to call twice."""
+        for zone in connection.subscriptions:
+            self._unroute(zone, connection)
+        if connection.id:
+            self._unroute(connection.id, connection)
+        if connection in self.connections:
+            self.connections.remove(connection)
+        if self.lod:
+            self.lod.forget_connection(connection)
+
+    def queue_depth(self) -> int:
+        return super().queue_depth() + sum(
+            len(c._queue) for c in self.connections)
 
     async def _authenticate(self, connection: ClientConnection) -> str:
-        """Validate credentials and return the client id."""
+        """Validate credentials and return the client id. An empty id means
+        the client was turned away.
+        """
         # Wait for the client to send credentials
         self.log("Waiting for authentication from", connection)
         data = await connection.reader.readline()
-        credentials = json.loads(data.decode())
+        handshake = json.loads(data.decode())
+
+        # Both ends must agree on the class ids used on the wire
+        if handshake.get("schema") != self.registry.fingerprint:
+            self.log("Rejecting", connection, "for a mismatched schema")
+            connection.writer.write(b'\n')
+            return ""
 
         # Let the subclass decide if this the credentials are valid
-        client_id = await self.validate_credentials(credentials)
+        client_id = await self.validate_credentials(handshake["credentials"])
 
         # Send the client its new id
         connection.writer.write(str(client_id).encode() + b'\n')
@@ -69,11 +276,14 @@ class PastryAgent(InternalMessagingServer):
 
     def startup(self):
         """Run the server loop and begin accepting connections."""
-        # TODO: Move host:port to an argument?
         coroutine = asyncio.start_server(
-            self._create_client_connection, '127.0.0.1', 8888, loop=self._loop)
+            self._create_client_connection, self.host, self.port,
+            reuse_port=self.reuse_port or None)
         self.server = self._loop.run_until_complete(coroutine)
         super().startup()
+        if self.lod:
+            self._lod_task = asyncio.ensure_future(
+                self._release_held(), loop=self._loop)
 
     def run(self):
         """Start the server process."""
@@ -87,6 +297,9 @@ class PastryAgent(InternalMessagingServer):
         self.shutdown()
 
     def shutdown(self):
+        if self._lod_task:
+            self._lod_task.cancel()
+        super().shutdown()
         self.server.close()
         self._loop.run_until_complete(self.server.wait_closed())
         self._loop.close()
@@ -96,17 +309,25 @@ class PastryAgent(InternalMessagingServer):
         client.
         """
         # Keep this connection around for a while
-        connection = ClientConnection(reader, writer)
+        connection = ClientConnection(
+            reader, writer, FrameDecoder(self.registry),
+            policy=self.slow_client_policy,
+            high_water=self.send_queue_high_water,
+            low_water=self.send_queue_low_water,
+            limit=self.send_queue_limit)
         self.connections.append(connection)
 
         # TODO: Finish authentication process
         client_id = await self._authenticate(connection)
         if not client_id:
-            self.finished = True
+            writer.close()
+            self.connections.remove(connection)
+            return
         connection.id = client_id
+        connection.start_sending(self._loop)
 
-        # Sign up for internal private messages for this user
-        self.internal_subscribe(connection.id)
+        # Whispers to this user come through the inbox
+        self._route(connection.id, connection, subscribe=False)
 
         while not self.finished:
             try:
@@ -120,26 +341,24 @@ class PastryAgent(InternalMessagingServer):
                 self.log("Something happened!", exc)
                 break
             # Handle the message
-            await self._read_message(connection, msg)
+            try:
+                await self._read_message(connection, msg)
+            except ProtocolError as exc:
+                self.log("Bad frame from {}: {}".format(connection, exc))
+                break
 
         # Cleanup
         self.log("Close the socket for {}".format(connection))
-        writer.close()
+        connection.kick()
         # Tell all relevant servers that the client has left
         for zone in connection.subscriptions:
             channel = Channel(target=zone, method="leave")
-            self.internal_broadcast(channel, connection.id)
-        self.internal_unsubscribe(connection.id)
-        self.connections.remove(connection)
+            self.internal_broadcast(channel, connection.id.encode('utf8'))
+        self._forget(connection)
 
     async def _read_message(self, sender: ClientConnection, data: bytes):
-        for d in [_ for _ in data.split(b'\n') if _]:
-            # Decode the message
-            raw_message = d.decode('utf8')
-
-            input_channel, message = raw_message.split("|")
-            channel = Channel.parse(input_channel)
-
+        # The decoder holds on to partial frames until the rest arrives
+        for channel, message in sender.decoder.feed(data):
             # Join requests
             if channel.method == 'join':
                 # TODO: Hang up on any requests that aren't permitted
@@ -148,27 +367,28 @@ class PastryAgent(InternalMessagingServer):
                 # TODO: Can we reject subscriptions to unknown zones?
                 # TODO: Can ONLY subscribe to zones
                 self.log("Joining", sender, "to", channel.target)
-                sender.subscriptions.append(channel.target)
-                self.internal_subscribe(channel.target)
-                # Trigger the sync the state of the subscription
-                self.internal_broadcast(channel, sender.id)
+                sender.subscriptions.add(channel.target)
+                self._route(channel.target, sender)
+                # Trigger the sync the state of the subscription, which is
+                # whispered back through our inbox
+                join = Channel(target=channel.target, method="join",
+                               reply_to=self.inbox)
+                self.internal_broadcast(join, sender.id.encode('utf8'))
             # Leave request. No permission necessary.
             elif channel.method == 'leave':
-                self.log("Removing", sender, "from", d)
-                # TODO: Don't crash if it's not in the list
-                sender.subscriptions.remove(channel.target)
-                # TODO: Check all subscriptions to see if this is needed any
-                # more. Others are probably still using it!
-                self.internal_unsubscribe(channel.target)
+                self.log("Removing", sender, "from", channel.target)
+                sender.subscriptions.discard(channel.target)
+                self._unroute(channel.target, sender)
+                self._send_skipped_enters(sender, channel.target)
                 # TODO: Trigger a delete state for the leaver
-                self.internal_broadcast(channel, sender.id)
+                self.internal_broadcast(channel, sender.id.encode('utf8'))
             else:
-                self.log("Some other message", sender, "from", d)
+                self.log("Some other message", sender, "from", channel)
                 # This is a non-pubsub message; forward to the do handler
                 await self._handle_client_message(sender, channel, message)
 
     async def _handle_client_message(self, sender: ClientConnection,
-                                     channel: Channel, message: str):
+                                     channel: Channel, message: bytes):
         # TODO: Why async?
         # TODO: This should receive channels too?
         # Subscription requests are already handled; must be a
@@ -188,22 +408,76 @@ class PastryAgent(InternalMessagingServer):
         """Whenever the agent receives an internal message, it's forwarded
         to all relevant clients.
         """
-        asyncio.ensure_future(self.client_broadcast(channel, message),
-                              loop=self._loop)
+        if self.lod:
+            self.lod.observe(channel, message)
+            if channel.method == "batch":
+                # Updates may be held per client, so send them one by one
+                for c, m in decode_batch(channel, message):
+                    self.client_broadcast(c, m)
+                return
+        if channel.method == "enter":
+            # An object moved zones. Clients watching the old zone already
+            # have it from the update that moved it; the rest get it as a
+            # create.
+            from_zone, message = decode_enter(message)
+            channel = Channel(target=channel.target, method="create",
+                              code_name=channel.code_name)
+            watching = self.routes.get(from_zone, set()) & \
+                self.routes.get(channel.target, set())
+            if watching:
+                frame = encode_frame(channel, message, self.registry)
+                now = self._loop.time()
+                for c in watching:
+                    c.skipped_enters.append(
+                        (now, from_zone, channel.target, frame))
+            self.client_broadcast(channel, message, skip=watching)
+            return
+        self.client_broadcast(channel, message)
+
+    def _send_skipped_enters(self, connection: ClientConnection, zone: str):
+        """Send the recent enters skipped because the connection watched a
+        zone it has just left.
+        """
+        skipped, now = connection.skipped_enters, self._loop.time()
+        while skipped and now - skipped[0][0] > self.enter_grace:
+            skipped.popleft()
+        kept = deque()
+        for entry in skipped:
+            _, from_zone, target, frame = entry
+            if from_zone != zone:
+                kept.append(entry)
+            elif target in connection.subscriptions:
+                connection.send(frame)
+        connection.skipped_enters = kept
 
-    async def client_broadcast(self, channel: Channel, data: str):
-        connections = [c for c in self.connections if c.responds_to(channel)]
+    def client_broadcast(self, channel: Channel, data: bytes, skip=()):
+        """Encode the frame once and queue it for every interested client
+        not in skip. This never waits on a socket, so one slow client can't
+        hold up the others.
+        """
+        connections = self.routes.get(channel.target, ())
+        if skip:
+            connections = [c for c in connections if c not in skip]
         # TODO: Handle channels better on the client itself
-        self.log("Sending: {} to {} connections".format(
-            data, len(connections)))
-        to_send = json.dumps({
-            "channel": str(channel),
-            "data": data
-        })
+        self.log("Sending {} ({} bytes) to {} connections".format(
+            channel, len(data), len(connections)))
+        to_send = encode_frame(channel, data, self.registry)
+        update = None
+        if channel.method == "update":
+            # Read once here rather than by every connection's queue
+            update = peek_fields(data)
+            if self.lod:
+                now = self._loop.time()
+                connections = [c for c in connections if not self.lod.hold(
+                    c, channel.target, data, now)]
         for c in connections:
-            try:
-                c.writer.write(to_send.encode() + b'\n')
-                await c.writer.drain()
-            except ConnectionResetError:
-                self.log("Lost connection to {}. Killing...".format(c))
-                self.connections.remove(c)
+            c.send(to_send, update)
+
+    async def _release_held(self):
+        """Send updates held back by the network LOD once they're due."""
+        while True:
+            await asyncio.sleep(1 / self.lod_tick_rate)
+            for c, target, payload in list(self.lod.due(self._loop.time())):
+                frame = encode_frame(Channel(target=target, method="update"),
+                                     payload, self.registry)
+                c.send(frame, peek_fields(payload))
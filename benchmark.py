@@ -0,0 +1,300 @@
+"""
+End to end benchmarks for Pastry. Each scenario starts a zone and an agent
+talking over a LocalTransport, connects simulated PastryClients to the agent
+over loopback TCP, drives some load and reports:
+
+ * creates and updates delivered to clients per second
+ * fan-out latency: from one client's save to the others' callbacks
+ * bytes received by clients per message
+ * for `join`, how long a new client takes to sync zones of several sizes
+
+Everything shares one process and event loop, so the numbers are for
+comparing runs and catching regressions, not absolute capacity. Runs with
+the same seed drive the same load.
+
+Usage: python benchmark.py [chat] [chess] [movement] [join] [--clients N]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import random
+from uuid import uuid4
+
+from agent import PastryAgent
+from client import PastryClient
+from distributed_objects import DistributedObject, Field, \
+    DistributedObjectClassRegistry
+from transports import LocalTransport
+from zone import PastryZone
+
+ZONE = "bench"
+
+
+class Timed(DistributedObject):
+    """Everything a benchmark sends says who sent it and when."""
+    sent_by = Field(str)
+    sent_at = Field(float)
+
+
+class Heartbeat(Timed):
+    text = Field(str)
+
+
+class Piece(Timed):
+    square = Field(int, index=True)
+    color = Field(str)
+
+
+class Walker(Timed):
+    x = Field(float, precision=0.01)
+    y = Field(float, precision=0.01)
+
+
+BENCH_REGISTRY = DistributedObjectClassRegistry(Heartbeat, Piece, Walker)
+
+
+class BenchZone(PastryZone):
+    zone_id = ZONE
+    registry = BENCH_REGISTRY
+
+    def log(self, *messages):
+        pass
+
+
+class BenchAgent(PastryAgent):
+    registry = BENCH_REGISTRY
+
+    def log(self, *messages):
+        pass
+
+    async def validate_credentials(self, credentials: dict) -> str:
+        return str(uuid4())
+
+
+class BenchClient(PastryClient):
+    """Counts what arrives, and how long it took to arrive."""
+    registry = BENCH_REGISTRY
+
+    def __init__(self, loop=None):
+        super().__init__(loop=loop)
+        self.creates = self.updates = self.bytes_received = 0
+        self.latencies = []
+        self.synced = asyncio.Event()
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port)
+        with contextlib.redirect_stdout(io.StringIO()):
+            await self._authenticate({})
+        read = self._reader.read
+
+        async def counted_read(n):
+            data = await read(n)
+            self.bytes_received += len(data)
+            return data
+        self._reader.read = counted_read
+        asyncio.ensure_future(self.receive(), loop=self._loop)
+
+    def _arrived(self, o: Timed):
+        if o.sent_by and o.sent_by != self.id:
+            self.latencies.append(self._loop.time() - o.sent_at)
+
+    def object_created(self, distributed_object):
+        self.creates += 1
+        self._arrived(distributed_object)
+
+    def object_updated(self, distributed_object):
+        self.updates += 1
+        self._arrived(distributed_object)
+
+    def interest_complete(self, zone_id: str):
+        self.synced.set()
+
+    async def close(self):
+        self.finished = True
+
+
+class Bench:
+    """A zone, an agent and some connected clients on a fresh event loop."""
+    def __init__(self, clients: int, port: int, seed: int):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.rng = random.Random(seed)
+        transport = LocalTransport()
+        self.zone = BenchZone(loop=self.loop, transport=transport)
+        BenchAgent.port = BenchClient.port = port
+        self.agent = BenchAgent(loop=self.loop, transport=transport)
+        self.clients = [BenchClient(loop=self.loop) for _ in range(clients)]
+        self.zone.startup()
+        self.agent.startup()
+
+    async def join(self, client: BenchClient):
+        await client.connect()
+        client.subscribe(ZONE)
+        await client.synced.wait()
+
+    async def connect_all(self):
+        for c in self.clients:
+            await self.join(c)
+
+    def reset(self):
+        for c in self.clients:
+            c.creates = c.updates = c.bytes_received = 0
+            c.latencies = []
+
+    def report(self, name: str, seconds: float):
+        creates = sum(c.creates for c in self.clients)
+        updates = sum(c.updates for c in self.clients)
+        received = sum(c.bytes_received for c in self.clients)
+        latencies = sorted(t for c in self.clients for t in c.latencies)
+
+        def ms(p):
+            if not latencies:
+                return float("nan")
+            return 1000 * latencies[int(p * (len(latencies) - 1))]
+        print("{:<10}{:>8}{:>11.0f}{:>11.0f}{:>9.1f}{:>9.1f}{:>9.1f}{:>10.1f}"
+              .format(name, len(self.clients), creates / seconds,
+                      updates / seconds, ms(.5), ms(.9), ms(.99),
+                      received / max(1, creates + updates)))
+
+    def close(self):
+        # Hang up, and give everyone a moment to notice before cancelling
+        for c in self.clients:
+            if c._writer:
+                c._writer.close()
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        tasks = [t for t in asyncio.all_tasks(self.loop) if not t.done()]
+        for t in tasks:
+            t.cancel()
+        self.loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        self.zone.shutdown()
+        self.agent.shutdown()  # Also closes the loop
+
+
+async def _run_for(bench: Bench, seconds: float, actor):
+    """Run actor(client, deadline) for every client at once."""
+    deadline = bench.loop.time() + seconds
+    await asyncio.gather(*(actor(c, deadline) for c in bench.clients))
+
+
+async def chat(bench: Bench, seconds: float):
+    """Every client creates a chat message about ten times a second."""
+    async def talk(c, deadline):
+        while bench.loop.time() < deadline:
+            c.save(Heartbeat(text="Heartbeat", zone=ZONE, sent_by=c.id,
+                             sent_at=bench.loop.time()))
+            await asyncio.sleep(bench.rng.uniform(0.05, 0.15))
+    await _run_for(bench, seconds, talk)
+
+
+async def chess(bench: Bench, seconds: float):
+    """Clients move the zone's 32 pieces to random squares, each about
+    twice a second.
+    """
+    async def move(c, deadline):
+        while bench.loop.time() < deadline:
+            pieces = c.objects.filter(cls=Piece)
+            piece = bench.rng.choice(pieces)
+            piece.square = bench.rng.randrange(64)
+            piece.sent_by, piece.sent_at = c.id, bench.loop.time()
+            c.save(piece)
+            await asyncio.sleep(bench.rng.uniform(0.3, 0.7))
+    await _run_for(bench, seconds, move)
+
+
+def _set_up_chess(bench: Bench):
+    bench.zone.save(*[
+        Piece(square=s, color="white" if s < 32 else "black", zone=ZONE)
+        for s in list(range(16)) + list(range(48, 64))])
+
+
+async def movement(bench: Bench, seconds: float):
+    """Every client walks its own character around at 20 updates a second."""
+    walkers = {}
+    for c in bench.clients:
+        walkers[c] = Walker(x=0.0, y=0.0, zone=ZONE, owner=c.id,
+                            sent_by=c.id, sent_at=bench.loop.time())
+        c.save(walkers[c])
+    await asyncio.sleep(0.5)  # Let the creates settle before measuring
+    bench.reset()
+
+    async def walk(c, deadline):
+        w = walkers[c]
+        while bench.loop.time() < deadline:
+            w.x += bench.rng.uniform(-1, 1)
+            w.y += bench.rng.uniform(-1, 1)
+            w.sent_at = bench.loop.time()
+            c.save(w)
+            await asyncio.sleep(0.05)
+    await _run_for(bench, seconds, walk)
+
+
+SCENARIOS = {"chat": (chat, None), "chess": (chess, _set_up_chess),
+             "movement": (movement, None)}
+
+
+def run_scenario(name: str, clients: int, seconds: float, port: int,
+                 seed: int):
+    scenario, set_up = SCENARIOS[name]
+    bench = Bench(clients, port, seed)
+    try:
+        if set_up:
+            set_up(bench)
+        bench.loop.run_until_complete(bench.connect_all())
+        bench.reset()
+        start = bench.loop.time()
+        bench.loop.run_until_complete(scenario(bench, seconds))
+        # Give the last messages a moment to land
+        bench.loop.run_until_complete(asyncio.sleep(0.2))
+        bench.report(name, bench.loop.time() - start)
+    finally:
+        bench.close()
+
+
+def run_join(sizes, port: int, seed: int):
+    """Time a client's join against zones holding more and more objects."""
+    for size in sizes:
+        bench = Bench(1, port, seed)
+        try:
+            bench.zone.save(*[
+                Walker(x=bench.rng.uniform(0, 100),
+                       y=bench.rng.uniform(0, 100), zone=ZONE)
+                for _ in range(size)])
+            start = bench.loop.time()
+            bench.loop.run_until_complete(bench.join(bench.clients[0]))
+            client = bench.clients[0]
+            print("join      {:>8} objects{:>10.1f} ms{:>12} bytes".format(
+                size, 1000 * (bench.loop.time() - start),
+                client.bytes_received))
+        finally:
+            bench.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("scenarios", nargs="*",
+                        help="any of chat, chess, movement and join "
+                             "(default: all of them)")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--join-sizes", type=int, nargs="+",
+                        default=[100, 1000, 10000])
+    parser.add_argument("--port", type=int, default=8890)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    names = args.scenarios or list(SCENARIOS) + ["join"]
+    for name in names:
+        if name not in SCENARIOS and name != "join":
+            parser.error("unknown scenario: {}".format(name))
+
+    print("{:<10}{:>8}{:>11}{:>11}{:>9}{:>9}{:>9}{:>10}".format(
+        "scenario", "clients", "creates/s", "updates/s", "p50 ms", "p90 ms",
+        "p99 ms", "bytes/msg"))
+    for name in names:
+        if name == "join":
+            run_join(args.join_sizes, args.port, args.seed)
+        else:
+            run_scenario(name, args.clients, args.seconds, args.port,
+                         args.seed)
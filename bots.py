@@ -0,0 +1,383 @@
+"""
+Headless bots for load generation and soak tests. Each bot is a PastryClient
+with a script: connect, join a room, create a walker, then move it, chat and
+now and then hop to another room until the run is over. Thousands of bots
+share each process's event loop, and a small process pool spreads them over
+more cores.
+
+Every message a bot sends says who sent it and when, and the agent echoes it
+back, so each bot records its own round trip latencies. Bots also record how
+long joins take to sync and every error they run into. Anything still not
+echoed a little after the run ends counts as lost.
+
+Start a soak server (needs Redis, or use --local for one process without it):
+    python bots.py serve --agents 4
+Then point the bots at it:
+    python bots.py run --bots 2000 --processes 4 --ramp 30 --duration 300
+
+Each bot holds a socket open, on both ends, so raise `ulimit -n` to match.
+"""
+import argparse
+import asyncio
+import contextlib
+import csv
+import io
+import multiprocessing
+import random
+import resource
+import signal
+from collections import Counter, defaultdict, deque
+
+from benchmark import BENCH_REGISTRY, BenchAgent, BenchZone, Heartbeat, \
+    Walker
+from client import PastryClient
+from multiserver import MultiServer
+from supervisor import Supervisor
+from transports import LocalTransport
+
+
+def _room(number: int) -> str:
+    return "soak:{}".format(number)
+
+
+class SoakZone(BenchZone):
+    """Owns every room. Walkers and chat leave with the bot that made them,
+    and only the last keep_messages chat messages of a room are kept.
+    """
+    zone_id = "soak"
+    cells = tuple(_room(i) for i in range(4))
+    keep_messages = 50
+
+    def setup(self):
+        self._messages = defaultdict(deque)
+
+    def object_created(self, obj):
+        if not isinstance(obj, Heartbeat):
+            return
+        messages = self._messages[obj.zone]
+        messages.append(obj.id)
+        while len(messages) > self.keep_messages:
+            old = self.objects.get(messages.popleft())
+            if old is not None:
+                old._delete()
+                self.save(old)
+
+    def client_disconnected(self, client_id: str):
+        for o in self.objects.filter(owner=client_id):
+            o._delete()
+            self.save(o)
+
+
+class SoakAgent(BenchAgent):
+    reuse_port = True
+
+
+class Bot(PastryClient):
+    """A scripted client that keeps score of its own latency and errors."""
+    registry = BENCH_REGISTRY
+    connect_timeout = 10.0
+    sync_timeout = 10.0
+    echo_timeout = 2.0  # Echoes still missing this long after the end are lost
+
+    def __init__(self, number: int, options, loop=None):
+        super().__init__(loop=loop)
+        self.number = number
+        self.options = options
+        self.rng = random.Random(options.seed * 1000003 + number)
+        self.connected = False
+        self.sent = self.echoed = 0
+        self._awaiting = set()  # (id, sent_at) of messages not yet echoed
+        self.latencies = []
+        self.sync_times = []
+        self.errors = Counter()
+        self._synced = {}  # zone -> Event set when its sync completes
+        self._hanging_up = False
+
+    # Hooks
+    def object_created(self, distributed_object):
+        self._echo(distributed_object)
+
+    def object_updated(self, distributed_object):
+        self._echo(distributed_object)
+
+    def interest_complete(self, zone_id: str):
+        if zone_id in self._synced:
+            self._synced[zone_id].set()
+
+    def _echo(self, o):
+        # Joins also bring back things we sent long ago; only count echoes
+        key = (o.id, o.sent_at)
+        if o.sent_by == self.id and key in self._awaiting:
+            self._awaiting.remove(key)
+            self.echoed += 1
+            self.latencies.append(self._loop.time() - o.sent_at)
+
+    async def receive(self):
+        try:
+            await super().receive()
+        except Exception as exc:
+            self.errors["receive: {}".format(type(exc).__name__)] += 1
+            self.finished = True
+
+    async def close(self):
+        # The base client stops the loop, which every other bot is using
+        if not self.finished and not self._hanging_up:
+            self.errors["disconnected"] += 1
+        self.finished = True
+
+    # The script
+    async def live(self, start_at: float, stop_at: float):
+        await asyncio.sleep(max(0.0, start_at - self._loop.time()))
+        try:
+            await asyncio.wait_for(self._connect(), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as exc:
+            self.errors["connect: {}".format(type(exc).__name__)] += 1
+            return
+        self.connected = True
+        try:
+            await self._play(stop_at)
+            # Give the last echoes a chance to arrive
+            deadline = self._loop.time() + self.echo_timeout
+            while self._awaiting and not self.finished and \
+                    self._loop.time() < deadline:
+                await asyncio.sleep(0.05)
+        finally:
+            if self._awaiting:
+                self.errors["lost"] += len(self._awaiting)
+            self._hang_up()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port)
+        await self._authenticate({})
+        self._receiver = asyncio.ensure_future(self.receive(),
+                                               loop=self._loop)
+
+    async def _play(self, stop_at: float):
+        opts, rng, loop = self.options, self.rng, self._loop
+        room = _room(rng.randrange(opts.rooms))
+        if not await self._join(room):
+            return
+        walker = Walker(x=rng.uniform(0, 100), y=rng.uniform(0, 100),
+                        zone=room, owner=self.id)
+        self._send_timed(walker)
+
+        now = loop.time()
+        next_move = now + rng.uniform(0, 1 / opts.move_rate) \
+            if opts.move_rate else float("inf")
+        next_chat = self._after(now, opts.chat_rate)
+        next_hop = self._after(now, opts.hop_rate)
+        while not self.finished:
+            at = min(next_move, next_chat, next_hop, stop_at)
+            await asyncio.sleep(max(0.0, at - loop.time()))
+            now = loop.time()
+            if now >= stop_at or self.finished:
+                break
+            if now >= next_move:
+                walker.x += rng.uniform(-1, 1)
+                walker.y += rng.uniform(-1, 1)
+                self._send_timed(walker)
+                next_move += 1 / opts.move_rate
+            if now >= next_chat:
+                self._send_timed(Heartbeat(
+                    text="Bot {} says hi".format(self.number),
+                    zone=walker.zone, owner=self.id))
+                next_chat = self._after(now, opts.chat_rate)
+            if now >= next_hop and opts.rooms > 1:
+                old = walker.zone
+                new = _room(rng.choice(
+                    [i for i in range(opts.rooms) if _room(i) != old]))
+                # Watch the new room before walking into it
+                if not await self._join(new):
+                    return
+                walker.zone = new
+                self._send_timed(walker)
+                self.unsubscribe(old)
+                next_hop = self._after(now, opts.hop_rate)
+
+    def _after(self, now: float, rate: float) -> float:
+        """When to next do something that happens rate times a second."""
+        return now + self.rng.expovariate(rate) if rate else float("inf")
+
+    def _send_timed(self, o):
+        o.sent_by, o.sent_at = self.id, self._loop.time()
+        self.sent += 1
+        self._awaiting.add((o.id, o.sent_at))
+        self.save(o)
+
+    async def _join(self, zone: str) -> bool:
+        """Join a zone and wait for its sync. False if it never came."""
+        self._synced[zone] = asyncio.Event()
+        start = self._loop.time()
+        self.subscribe(zone)
+        try:
+            await asyncio.wait_for(self._synced[zone].wait(),
+                                   self.sync_timeout)
+        except asyncio.TimeoutError:
+            self.errors["sync timeout"] += 1
+            return False
+        finally:
+            del self._synced[zone]
+        self.sync_times.append(self._loop.time() - start)
+        return True
+
+    def _hang_up(self):
+        self._hanging_up = True
+        if self._writer:
+            self._writer.close()
+
+    def stats(self) -> dict:
+        return {"bot": self.number, "id": self.id,
+                "connected": self.connected, "sent": self.sent,
+                "echoed": self.echoed, "latencies": self.latencies,
+                "sync_times": self.sync_times, "errors": dict(self.errors)}
+
+
+def _raise_file_limit():
+    """Let this process hold as many sockets as the system allows."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _run_bots(numbers, options) -> list:
+    """Run some of the bots on an event loop of this process's own."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _raise_file_limit()
+    Bot.host, Bot.port = options.host, options.port
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bots = [Bot(n, options, loop=loop) for n in numbers]
+    now = loop.time()
+    stop_at = now + options.ramp + options.duration
+    # Start times are spread over the ramp across every process
+    lives = [b.live(now + options.ramp * b.number / options.bots, stop_at)
+             for b in bots]
+    # The client's chatter about authenticating would drown out the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        loop.run_until_complete(asyncio.gather(*lives))
+        # Give the agent a moment to see the hang ups
+        loop.run_until_complete(asyncio.sleep(0.5))
+        tasks = [t for t in asyncio.all_tasks(loop) if not t.done()]
+        for t in tasks:
+            t.cancel()
+        loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+    return [b.stats() for b in bots]
+
+
+def _percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    return values[int(p * (len(values) - 1))]
+
+
+def report(results: list, csv_path=None):
+    latencies = sorted(t for r in results for t in r["latencies"])
+    syncs = sorted(t for r in results for t in r["sync_times"])
+    errors = Counter()
+    for r in results:
+        errors.update(r["errors"])
+    connected = sum(r["connected"] for r in results)
+    sent = sum(r["sent"] for r in results)
+    echoed = sum(r["echoed"] for r in results)
+
+    print("Bots:      {} started, {} connected".format(len(results),
+                                                        connected))
+    print("Messages:  {} sent, {} echoed back".format(sent, echoed))
+    print("Latency:   p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, "
+          "max {:.1f} ms".format(*[1000 * _percentile(latencies, p)
+                                   for p in (.5, .9, .99, 1)]))
+    print("Join sync: p50 {:.1f} ms, p99 {:.1f} ms".format(
+        *[1000 * _percentile(syncs, p) for p in (.5, .99)]))
+    if errors:
+        print("Errors:    " + ", ".join(
+            "{} {}".format(n, e) for e, n in errors.most_common()))
+    else:
+        print("Errors:    none")
+
+    # The bots that had the worst of it
+    worst = sorted((r for r in results if r["latencies"]),
+                   key=lambda r: -max(r["latencies"]))[:5]
+    for r in worst:
+        print("  bot {:<6} max {:.1f} ms over {} echoes".format(
+            r["bot"], 1000 * max(r["latencies"]), len(r["latencies"])))
+
+    if csv_path:
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["bot", "id", "connected", "sent", "echoed",
+                             "p50_ms", "p99_ms", "max_ms", "sync_ms",
+                             "errors"])
+            for r in results:
+                own = sorted(r["latencies"])
+                writer.writerow([
+                    r["bot"], r["id"], r["connected"], r["sent"],
+                    r["echoed"],
+                    "{:.2f}".format(1000 * _percentile(own, .5)),
+                    "{:.2f}".format(1000 * _percentile(own, .99)),
+                    "{:.2f}".format(1000 * _percentile(own, 1)),
+                    "{:.2f}".format(1000 * sum(r["sync_times"]) /
+                                    max(1, len(r["sync_times"]))),
+                    ";".join("{}={}".format(e, n)
+                             for e, n in sorted(r["errors"].items()))])
+
+
+def run(options):
+    numbers = list(range(options.bots))
+    processes = max(1, min(options.processes, options.bots))
+    # Deal the bots out so each process ramps up at the same pace
+    shares = [numbers[i::processes] for i in range(processes)]
+    if processes == 1:
+        results = _run_bots(shares[0], options)
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = [r for share in pool.starmap(
+                _run_bots, [(s, options) for s in shares]) for r in share]
+    report(sorted(results, key=lambda r: r["bot"]), options.csv)
+
+
+def serve(options):
+    _raise_file_limit()
+    SoakZone.cells = tuple(_room(i) for i in range(options.rooms))
+    SoakAgent.host, SoakAgent.port = options.host, options.port
+    if options.local:
+        to_start = MultiServer(SoakZone, SoakAgent,
+                               transport=LocalTransport())
+    else:
+        to_start = Supervisor(SoakZone, *[SoakAgent] * options.agents)
+    to_start.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="run a soak server")
+    serve_parser.add_argument("--agents", type=int, default=1)
+    serve_parser.add_argument("--local", action="store_true",
+                              help="one process, without Redis")
+
+    run_parser = commands.add_parser("run", help="run bots against it")
+    run_parser.add_argument("--bots", type=int, default=100)
+    run_parser.add_argument("--processes", type=int, default=1)
+    run_parser.add_argument("--ramp", type=float, default=10.0,
+                            help="seconds to spread the bots' starts over")
+    run_parser.add_argument("--duration", type=float, default=60.0,
+                            help="seconds to run once every bot's started")
+    run_parser.add_argument("--move-rate", type=float, default=2.0,
+                            help="walker moves per second")
+    run_parser.add_argument("--chat-rate", type=float, default=0.1,
+                            help="chat messages per second")
+    run_parser.add_argument("--hop-rate", type=float, default=0.02,
+                            help="room changes per second")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--csv", help="write per-bot results here")
+
+    for p in (serve_parser, run_parser):
+        p.add_argument("--host", default="127.0.0.1")
+        p.add_argument("--port", type=int, default=8888)
+        p.add_argument("--rooms", type=int, default=4)
+    args = parser.parse_args()
+    serve(args) if args.command == "serve" else run(args)
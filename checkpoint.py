@@ -0,0 +1,97 @@
+# coding=utf-8
+"""Checkpoint files of a zone's whole object state.
+
+FIELD:          TYPE:               NOTES:
+Magic           8 bytes             CHECKPOINT_MAGIC
+Fingerprint     16 bytes ascii      The registry fingerprint it was made with
+Object count    uint32
+Objects         (repeated)          Class id (uint16), payload length
+                                    (uint32), create payload
+
+The payloads are exactly what the zone sends on create, so writing one only
+needs the zone's already encoded copies, and reading one is a walk over the
+memory-mapped file with nothing decoded until the zone asks for it.
+"""
+import mmap
+import os
+import struct
+
+CHECKPOINT_MAGIC = b"PSTRYCP1"
+_HEADER = struct.Struct("!8s16sI")
+_ENTRY = struct.Struct("!HI")  # class id, payload length
+
+
+def write_checkpoint(path: str, fingerprint: str, objects: list):
+    """Write (class id, create payload) pairs to path. The file is replaced
+    in one step, so a crash mid-write leaves the last checkpoint intact.
+    This blocks, so zones call it from a worker thread.
+    """
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(_HEADER.pack(CHECKPOINT_MAGIC, fingerprint.encode('ascii'),
+                             len(objects)))
+        for class_id, payload in objects:
+            f.write(_ENTRY.pack(class_id, len(payload)))
+            f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+class CheckpointReader:
+    """Reads a checkpoint through a memory map, so only the pages actually
+    walked are read from disk.
+
+    Example usage:
+    with CheckpointReader(path, registry.fingerprint) as checkpoint:
+        for chunk in checkpoint.chunks(500):
+            ...
+    """
+    def __init__(self, path: str, fingerprint: str):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, stored, self.count = _HEADER.unpack_from(self._map)
+        except struct.error:
+            self.close()
+            raise ValueError("{} is too short to be a checkpoint".format(
+                path))
+        if magic != CHECKPOINT_MAGIC:
+            self.close()
+            raise ValueError("{} is not a checkpoint".format(path))
+        if stored.decode('ascii') != fingerprint:
+            self.close()
+            raise ValueError("{} was made with other classes".format(path))
+
+    def chunks(self, size: int):
+        """Yield lists of up to size (class id, create payload) pairs.
+        If the file was cut short, the whole entries before the cut are
+        yielded and then ValueError is raised.
+        """
+        offset, chunk, end = _HEADER.size, [], len(self._map)
+        for i in range(self.count):
+            length = None
+            if offset + _ENTRY.size <= end:
+                class_id, length = _ENTRY.unpack_from(self._map, offset)
+                offset += _ENTRY.size
+            if length is None or offset + length > end:
+                if chunk:
+                    yield chunk
+                raise ValueError("Checkpoint ends in object {} of {}".format(
+                    i, self.count))
+            chunk.append((class_id, self._map[offset:offset + length]))
+            offset += length
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
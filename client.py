@@ -3,9 +3,15 @@
 
 import asyncio
 import json
+from itertools import groupby
 from typing import List
 
 from distributed_objects import DistributedObjectState, DistributedObject
+from indexes import UniqueError
+from interest import EarlyUpdates
+from protocol import FrameDecoder, ProtocolError, decode_batch, \
+    decode_snapshot, encode_frame
+from schema import peek_id
 from settings import MAX_PACKET_SIZE
 from util import Channel
 
@@ -20,26 +26,49 @@ class PastryClient:
     finished = False
     registry = None
     id = None  # TODO: Don't permit network (except auth) until this is a thing
+    # The agent to connect to
+    host = '127.0.0.1'
+    port = 8888
+    # Interpolated fields are shown this many seconds in the past, so there's
+    # usually a keyframe on either side. About two update intervals is good.
+    interpolation_delay = 0.2
+    # Updates for objects we don't have are kept this many seconds, in case
+    # the object is about to enter one of our zones (see interest.py)
+    early_update_timeout = 2.0
 
     def __init__(self, loop=None):
         if not loop:
             loop = asyncio.get_event_loop()
         self._loop = loop
+        self.interests = set()  # Zones we've subscribed to
         self.objects = DistributedObjectState(
-            self.object_created, self.object_updated, self.object_deleted)
+            self.object_created, self.object_updated, self.object_deleted,
+            clock=loop.time)
+        self._early = EarlyUpdates(self.early_update_timeout)
 
     async def _authenticate(self, credentials):
         """No messages should be sent back and forth until this is completed."""
         print("Authenticating...")
         # Auth doesn't use the standard _send because it's not pubsub
-        self._writer.write(json.dumps(credentials).encode() + b'\n')
+        handshake = {"schema": self.registry.fingerprint,
+                     "credentials": credentials}
+        self._writer.write(json.dumps(handshake).encode() + b'\n')
         response = await self._reader.readline()
         self.id = response.decode().strip()
+        if not self.id:
+            raise ConnectionRefusedError(
+                "The agent rejected our credentials or class registry.")
         print("Authentication successful. Client ID:", self.id)
 
     def setup(self) -> None:
         pass
 
+    def render_time(self) -> float:
+        """The time to draw interpolated fields at, for example:
+        avatar.value_at('x', client.render_time())
+        """
+        return self._loop.time() - self.interpolation_delay
+
     # These are to be overridden by the implementer of the Client
     def object_created(self, distributed_object: DistributedObject) -> None:
         pass
@@ -50,45 +79,118 @@ class PastryClient:
     def object_deleted(self, distributed_object: DistributedObject) -> None:
         pass
 
+    def interest_complete(self, zone_id: str) -> None:
+        """Called once a joined zone's whole state has arrived."""
+        pass
+
     def save(self, *objects: List[DistributedObject]):
         """Takes a list of distributed objects and sends them across the
         network to be saved.
         """
         for o in objects:
             method = "update" if o.created else "create"
-
-            # Build the channel
-            c = Channel(target=o.zone, method=method,
-                        code_name=None if o.created else o.__class__.__name__)
+            # Writes that didn't change anything aren't worth sending
+            if method == "update" and not o.changed_fields():
+                o._save()
+                continue
+            if method == "update":
+                o._check(o._dirty_field_data)  # Before it's sent
+
+            # Build the channel. Updates go where listeners last saw it.
+            c = Channel(target=o._saved_field_data.get('zone', o.zone)
+                        if o.created else o.zone,
+                        method=method,
+                        code_name=None if o.created else str(
+                            self.registry.class_id(o.__class__)))
             # Send via the network
             self._send(c, o.serialize())
             # Move the dirty data over to the clean data
             o._save()
 
-    def _handle_message(self, channel: Channel, data: str):
+    def _handle_message(self, channel: Channel, data: bytes):
         # TODO: Also handle deleting DOs
         # TODO: A lot of this is repeated code on the client/zone. Can it be
         # generalized?
         if channel.method == 'create':
+            # An object moving zones is sent as a create to clients that
+            # weren't watching its old zone. If we already have it, say we
+            # moved it or left the old zone just after it moved, our copy is
+            # at least as new.
+            if self.objects.get(peek_id(data)) is not None:
+                return
             class_ = self.registry[channel.code_name]
-            created_object = class_(**json.loads(data))
+            created_object = class_.deserialize(data)
             # TODO: Maybe this should take in the registry or something
-            self.objects.create(created_object)
+            if not self._apply(self.objects.create, created_object):
+                return
+            # The mover's updates that beat its enter here
+            update = Channel(target=channel.target, method="update")
+            for d in self._early.take(channel.target, created_object.id):
+                self._handle_message(update, d)
         elif channel.method == 'update':
-            kwargs = json.loads(data)
-            self.objects.update(**kwargs)
+            obj = self.objects.get(peek_id(data))
+            if obj is None:
+                # Updates can beat a streamed join to an object, which will
+                # still arrive later with its newest values, or beat an
+                # object entering from a zone we aren't watching.
+                if channel.target in self.interests:
+                    self._early.hold(channel.target, peek_id(data), data,
+                                     self._loop.time())
+                return
+            from_zone = obj.zone
+            if not self._apply(self.objects.apply_update, data):
+                return
+            # It moved somewhere we aren't watching
+            if obj.zone != from_zone and obj.zone not in self.interests:
+                self._early.left(from_zone, obj.id, self._loop.time())
+                self.objects.delete(obj.id)
         elif channel.method == 'delete':
-            obj_id = json.loads(data)['id']
-            self.objects.delete(obj_id)
+            # Deletes still in flight when we left a zone, or for objects
+            # that moved out of sight, find nothing here
+            if self.objects.get(peek_id(data)) is not None:
+                self.objects.apply_delete(data)
+        elif channel.method == 'batch':
+            for c, d in decode_batch(channel, data):
+                self._handle_message(c, d)
+        elif channel.method == 'snapshot':
+            # Decode each run of same-class objects in one go, keeping order
+            objects = decode_snapshot(data)
+            for class_id, run in groupby(objects, key=lambda o: o[0]):
+                class_ = self.registry[class_id]
+                for o in class_.deserialize_many(p for _, p in run):
+                    self._apply(self.objects.create, o)
+                    # The snapshot already has anything we held for it
+                    self._early.take(o.zone, o.id)
+        elif channel.method == 'complete':
+            self.interest_complete(data.decode('utf8'))
+
+    @staticmethod
+    def _apply(change, *args) -> bool:
+        """Apply a change from the server, skipping it if it clashes with a
+        unique value we hold. Two clients can claim the same value at once;
+        the zone keeps one claim and sends corrections for the other.
+        """
+        try:
+            change(*args)
+        except UniqueError as exc:
+            print("Ignoring a clashing change:", exc)
+            return False
+        return True
 
     # Core Functions
     def subscribe(self, channel_name: str):
+        self.interests.add(channel_name)
         c = Channel(target=channel_name, method="join")
-        self._send(c, "")
+        self._send(c, b"")
 
     def unsubscribe(self, channel_name: str):
+        """Leave a zone, deleting our copies of the objects in it."""
+        self.interests.discard(channel_name)
         c = Channel(target=channel_name, method="leave")
-        self._send(c, "")
+        self._send(c, b"")
+        self._early.forget_zone(channel_name)
+        for o in self.objects.filter(zone=channel_name):
+            self.objects.delete(o.id)
 
     def run(self):
         self._loop.run_until_complete(self.establish_connection())
@@ -104,7 +206,7 @@ class PastryClient:
     async def establish_connection(self):
         # Establish the socket
         self._reader, self._writer = await asyncio.open_connection(
-            '127.0.0.1', 8888, loop=self._loop)
+            self.host, self.port)
 
         # TODO: Authentication
         credentials = {"cool": "beans"}
@@ -116,8 +218,8 @@ class PastryClient:
         self.setup()
 
     async def receive(self):
-        msg = None
-        leftovers = b''
+        msg = b''
+        decoder = FrameDecoder(self.registry)
         while not self.finished:
             try:
                 msg = await self._reader.read(MAX_PACKET_SIZE)
@@ -130,24 +232,18 @@ class PastryClient:
             except Exception as exc:
                 print("Something happened!", exc)
                 await self.close()
-            msg = leftovers + msg
-            leftovers = b''
-            messages = msg.split(b"\n")
-            for m in messages:
-                m = m.strip()
-                if not m:
-                    continue
-                try:
-                    message = json.loads(m.decode('utf8'))
-                    c = Channel.parse(message['channel'])
-                    self._handle_message(c, message['data'])
-                except ValueError:
-                    # Didn't get the full message, save for next time.
-                    leftovers = m
-
-    def _send(self, channel: Channel, data: str):
-        channel_data = str(channel).encode()
-        self._writer.write(channel_data + b"|" + data.encode() + b"\n")
+            try:
+                # Partial frames are kept by the decoder until completed
+                messages = decoder.feed(msg)
+            except ProtocolError as exc:
+                print("Bad frame from server!", exc)
+                await self.close()
+                break
+            for c, data in messages:
+                self._handle_message(c, data)
+
+    def _send(self, channel: Channel, data: bytes):
+        self._writer.write(encode_frame(channel, data, self.registry))
 
     async def close(self):
         print("Closing")
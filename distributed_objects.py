@@ -3,13 +3,52 @@
 objects would inherit.
 """
 
-import json
+import hashlib
+from collections import defaultdict
+from typing import Iterable, List
 from uuid import uuid4
 
+from indexes import FieldIndex
+from interpolation import KeyframeBuffer
+from schema import Schema, peek_id
+
+_ANY = object()  # Means "don't filter on this" where None is meaningful
+
 
 class Field:
-    def __init__(self, property_type):
+    def __init__(self, property_type, *, index=False, unique=False,
+                 sorted=False, precision=None, interpolate=False,
+                 db=False):
+        """
+        index: Keep a hash index so `where` lookups on this field are cheap.
+        unique: Like index, but no two objects may share a value.
+        sorted: Like index, but also support `range` lookups.
+        precision: Float fields only. Send the value as a 32 bit multiple of
+           this, and ignore changes smaller than it.
+        interpolate: Float fields only. Clients keep keyframes of the value
+           so they can smooth it out between updates (see value_at).
+        db: Persist this field, on zones that have a database.
+        """
+        if precision is not None and property_type is not float:
+            raise TypeError("precision only applies to float fields")
+        if interpolate and property_type is not float:
+            raise TypeError("interpolate only applies to float fields")
+        if (index or unique or sorted) and property_type.__hash__ is None:
+            raise TypeError("{} values can't be indexed".format(
+                property_type.__name__))
         self.t = property_type
+        self.precision = precision
+        self.interpolate = interpolate
+        self.db = db
+        self.unique = unique
+        self.sorted = sorted
+        self.indexed = index or unique or sorted
+
+    def same(self, a, b) -> bool:
+        """Whether two values would look the same on the wire."""
+        if self.precision and a is not None and b is not None:
+            return round(a / self.precision) == round(b / self.precision)
+        return a == b
 
 
 class DistributedObjectMetaclass(type):
@@ -18,11 +57,18 @@ class DistributedObjectMetaclass(type):
         # TODO: Why not put saved data in __dict__?
         attrs['_saved_field_data'] = {}  # This is where synced data go
         attrs['_dirty_field_data'] = {}  # This is where local changes go
+        # Every field, inherited ones first, in a fixed order for the schema
+        attrs['_fields'] = {}
+        for base in reversed(baseclasses):
+            attrs['_fields'].update(getattr(base, '_fields', {}))
+            attrs['_dirty_field_data'].update(
+                getattr(base, '_dirty_field_data', {}))
         for name, thing in list(attrs.items()):
             # only override functionality for "DistributedField" objects
             # TODO: And methods decorated with @distributed?
             if not isinstance(thing, Field):
                 continue
+            attrs['_fields'][name] = thing
 
             # initialize the data in a type-specific way
             attrs['_dirty_field_data'][name] = {
@@ -33,7 +79,6 @@ class DistributedObjectMetaclass(type):
                 bool: False,
                 # TODO: UUID?
                 # TODO: Datetime?
-                # TODO: Keyframe (Datetime, Value) field?
             }.get(thing.t, None)
 
             # Create properties only for the specified fields.
@@ -61,6 +106,13 @@ class DistributedObjectMetaclass(type):
                 # TODO: Use the "help" param on the field for doc
             )
 
+        attrs['_schema'] = Schema(classname, attrs['_fields'])
+        attrs['_indexed_fields'] = tuple(
+            n for n, f in attrs['_fields'].items() if f.indexed)
+        attrs['_interpolated_fields'] = tuple(
+            n for n, f in attrs['_fields'].items() if f.interpolate)
+        attrs['_db_fields'] = tuple(
+            n for n, f in attrs['_fields'].items() if f.db)
         return super().__new__(mcs, classname, baseclasses, attrs)
 
 
@@ -71,6 +123,8 @@ class DistributedObject(metaclass=DistributedObjectMetaclass):
     owner = Field(str)  # Null means owned by the ZoneServer
     zone = Field(str)  # The id of the zone this DO belongs to.
 
+    _state = None  # The DistributedObjectState holding this, if any
+
     def __init__(self, *, zone=None, **kwargs):
         super().__init__()
         # Set the deleted flag
@@ -97,65 +151,210 @@ class DistributedObject(metaclass=DistributedObjectMetaclass):
         # This is only new is saved fields are not yet initialized
         return bool(self._saved_field_data)
 
+    def value_at(self, name: str, time: float):
+        """The value of an interpolated field at a time on the state's clock,
+        smoothed between the updates received around then. Falls back to
+        the current value when there are no keyframes.
+        """
+        if self._state is not None:
+            value = self._state.value_at(self.id, name, time)
+            if value is not None:
+                return value
+        return getattr(self, name)
+
+    def _check(self, data: dict) -> None:
+        """Raise, changing nothing, if these values would break a unique
+        index of the state holding this object.
+        """
+        if self._state is not None:
+            self._state._check(self, data)
+
     def _update(self, data: dict) -> None:
         # TODO: Nuke any keys in the dirty data that exist here?
+        self._check(data)
         self._saved_field_data.update(data)
+        if self._state is not None:
+            self._state._reindex(self)
 
     def _delete(self) -> None:
         self._deleted = True
 
     def _save(self) -> None:
+        self._check(self._dirty_field_data)
         self._saved_field_data.update(self._dirty_field_data)
         self._dirty_field_data.clear()
-
-    def serialize(self, for_create=False) -> str:
+        if self._state is not None:
+            self._state._reindex(self)
+
+    def changed_fields(self) -> dict:
+        """The dirty values that differ from the last synced ones. Writing a
+        field back to the value it already had isn't a change.
+        """
+        saved, fields = self._saved_field_data, self._fields
+        return {n: v for n, v in self._dirty_field_data.items()
+                if n not in saved or not fields[n].same(saved[n], v)}
+
+    def serialize(self, for_create=False) -> bytes:
         if for_create:
             # Just send everything if we're creating this
-            return json.dumps(self._saved_field_data)
-
-        # Always serialize id and zone, even if not dirty
-        self._dirty_field_data.update(id=self.id, zone=self.zone)
-        return json.dumps(self._dirty_field_data)
+            return self._schema.encode(self._saved_field_data)
+
+        # Only the changes go out, plus the id which is always serialized
+        data = self.changed_fields()
+        data['id'] = self.id
+        return self._schema.encode(data)
+
+    def serialize_fields(self, names: Iterable[str]) -> bytes:
+        """Serialize the current values of some fields, plus id and zone."""
+        data = {n: getattr(self, n) for n in names}
+        data.update(id=self.id, zone=self.zone)
+        return self._schema.encode(data)
+
+    @classmethod
+    def deserialize(cls, payload: bytes) -> "DistributedObject":
+        """Build an unsaved instance from a serialized create message. This
+        skips __init__, since the payload already carries the id and zone.
+        """
+        obj = cls.__new__(cls)
+        obj._deleted = False
+        obj._saved_field_data = {}
+        obj._dirty_field_data = cls._dirty_field_data.copy()
+        obj._dirty_field_data.update(cls._schema.decode(payload))
+        return obj
+
+    @classmethod
+    def deserialize_many(cls, payloads: Iterable[bytes]) -> List:
+        """Deserialize a batch of create messages for this class."""
+        new, defaults, decode = cls.__new__, cls._dirty_field_data, \
+            cls._schema.decode
+        objects = []
+        for payload in payloads:
+            obj = new(cls)
+            obj._deleted = False
+            obj._saved_field_data = {}
+            obj._dirty_field_data = dirty = defaults.copy()
+            dirty.update(decode(payload))
+            objects.append(obj)
+        return objects
 
 
 class DistributedObjectClassRegistry:
+    """Every DistributedObject class a game uses, each with a compact numeric
+    id. Ids follow the order the classes are registered in, so every process
+    must build the registry the same way; the fingerprint lets clients and
+    agents confirm that they did.
+    """
     def __init__(self, *args):
         # Validate these are actually DO subclasses
         if any(not issubclass(_, DistributedObject) for _ in args):
             raise TypeError("Only DistributedObject subclasses allowed.")
+        names = [c.__name__ for c in args]
+        duplicates = sorted({n for n in names if names.count(n) > 1})
+        if duplicates:
+            raise ValueError("Class names must be unique: {}".format(
+                ", ".join(duplicates)))
 
-        # Save them to the classes  TODO: Why not a dict?
         self._classes = args
+        self._by_id = {i: c for i, c in enumerate(args, 1)}
+        self._by_name = {c.__name__: c for c in args}
+        self._ids = {c: i for i, c in self._by_id.items()}
+        self.fingerprint = self._fingerprint()
+
+    def _fingerprint(self) -> str:
+        """A short hash of every class id and name, and of each field's name
+        and everything that decides its wire layout.
+        """
+        description = ";".join(
+            "{}:{}:{}".format(i, c.__name__, ",".join(
+                "{}={}@{!r}".format(n, getattr(f.t, '__name__', f.t),
+                                    f.precision)
+                for n, f in c._fields.items()))
+            for i, c in self._by_id.items())
+        return hashlib.sha256(description.encode('utf8')).hexdigest()[:16]
+
+    def __getitem__(self, key):
+        """Look up a class by its name or its numeric id (as an int or a
+        string of digits, which class names can never be).
+        """
+        try:
+            if isinstance(key, int):
+                return self._by_id[key]
+            if key.isdigit():
+                return self._by_id[int(key)]
+            return self._by_name[key]
+        except KeyError:
+            raise IndexError(
+                "{} is not a registered Distributed Object.".format(key))
+
+    def class_id(self, key) -> int:
+        """The numeric id of a class, given the class, its name or its id."""
+        class_ = key if isinstance(key, type) else self[key]
+        try:
+            return self._ids[class_]
+        except KeyError:
+            raise IndexError(
+                "{} is not a registered Distributed Object.".format(key))
 
-    def __getitem__(self, classname: str):
-        """Provide index access for class retrieval."""
-        for i in self._classes:
-            if i.__name__ == classname:
-                return i
-        raise IndexError(
-            "{} is not a registered Distributed Object.".format(classname))
+    def class_name(self, class_id: int) -> str:
+        """Look up a class name from its numeric id."""
+        return self[class_id].__name__
 
+    def __iter__(self):
+        return iter(self._classes)
+
+    def __len__(self):
+        return len(self._classes)
 
-class DistributedObjectState:
-    """Persists the object state on the zone server and the client."""
 
-    # TODO: Extend this with nice filtering for easier development.
-    # For example: self.objects.filter(class=Message)
-    def __init__(self, create_callback, update_callback, delete_callback):
-        self._instances = []
+class DistributedObjectState:
+    """Persists the object state on the zone server and the client.
+
+    Objects are stored by id, and also partitioned by class, owner and zone
+    so that filter() only has to look at the objects that could match.
+    Fields declared with index, unique or sorted get a FieldIndex for where()
+    and range(), shared by the declaring class and its subclasses only, so
+    unrelated classes can reuse a field name. Objects tell the state to
+    reindex them whenever they take on new values in _update or _save.
+
+    Given a clock, the state also keeps keyframes of every interpolated
+    field, stamped with that clock when the value arrives.
+    """
+    # Keyframes kept per interpolated field, and the longest extrapolation
+    keyframes = 8
+    max_extrapolation = 0.25
+
+    def __init__(self, create_callback, update_callback, delete_callback,
+                 clock=None):
+        self._instances = {}  # id -> object
+        # Each partition maps a key to {id: object}
+        self._by_class = defaultdict(dict)
+        self._by_owner = defaultdict(dict)
+        self._by_zone = defaultdict(dict)
+        self._filed_under = {}  # id -> the (owner, zone) it's filed under
+        self._indexes = {}  # (declaring class, field name) -> FieldIndex
+        self._class_indexes = {}  # class -> {field name: FieldIndex}
+        self.clock = clock
+        self._keyframes = {}  # id -> {field name: KeyframeBuffer}
         self.create_callback = create_callback
         self.update_callback = update_callback
         self.delete_callback = delete_callback
 
     def create(self, obj: DistributedObject):
-        # TODO: Should the actual packet parsing happen here too?
         # If the object already exists, just update it
         to_update = self.get(obj.id)
         if to_update:
             to_update._update(obj._dirty_field_data)
+            self._add_keyframes(to_update, obj._dirty_field_data)
             return
 
-        self._instances.append(obj)
+        if obj.__class__ not in self._class_indexes:
+            self._add_indexes(obj.__class__)
+        self._index(obj)
+        self._instances[obj.id] = obj
+        self._by_class[obj.__class__][obj.id] = obj
+        self._file(obj)
+        obj._state = self
+        self._add_keyframes(obj, obj._dirty_field_data)
         self.create_callback(obj)
         obj._save()
 
@@ -166,28 +365,218 @@ class DistributedObjectState:
         obj_id = fields['id']  # ID is always serialized
         obj = self[obj_id]
         obj._update(fields)
+        self._add_keyframes(obj, fields)
         self.update_callback(obj)
 
+    def apply_update(self, payload: bytes):
+        """Apply a serialized update message to the object it names."""
+        obj = self[peek_id(payload)]
+        self.update(**obj._schema.decode(payload))
+
+    def apply_delete(self, payload: bytes):
+        """Delete the object named by a serialized delete message."""
+        self.delete(peek_id(payload))
+
     def delete(self, obj_id: str):
         obj = self[obj_id]
-        self._instances.remove(obj)
+        del self._instances[obj_id]
+        self._remove_from(self._by_class, obj.__class__, obj_id)
+        self._unfile(obj_id)
+        for index in self._class_indexes[obj.__class__].values():
+            index.remove(obj_id)
+        obj._state = None
+        self._keyframes.pop(obj_id, None)
         self.delete_callback(obj)
 
+    def filter(self, cls=None, owner=_ANY, zone=_ANY) -> List:
+        """Find objects by class (including subclasses), owner and zone.
+        For example: self.objects.filter(cls=Message, zone="chat")
+        """
+        candidates = []
+        if owner is not _ANY:
+            candidates.append(self._by_owner.get(owner, {}))
+        if zone is not _ANY:
+            candidates.append(self._by_zone.get(zone, {}))
+        if cls is not None:
+            by_class = {}
+            for c, objects in self._by_class.items():
+                if issubclass(c, cls):
+                    by_class.update(objects)
+            candidates.append(by_class)
+        if not candidates:
+            return list(self._instances.values())
+
+        # Walk the smallest partition and check it against the others
+        candidates.sort(key=len)
+        smallest, *others = candidates
+        return [o for i, o in smallest.items()
+                if all(i in other for other in others)]
+
+    def where(self, **values) -> List:
+        """Find objects whose fields equal the given values. For example:
+        self.objects.where(square=12). Indexed fields are looked up directly;
+        any others are checked against what the indexes found.
+        """
+        candidates = [self._candidates(n, lambda i: True,
+                                       lambda i, v=v: i.find(v))
+                      for n, v in values.items()]
+        return self._query(
+            [c for c in candidates if c is not None],
+            lambda o: all(getattr(o, n, _ANY) == v
+                          for n, v in values.items()))
+
+    def range(self, **bounds) -> List:
+        """Find objects whose fields fall within inclusive (low, high) bounds.
+        Either bound may be None. For example:
+        self.objects.range(hp=(0, 10))
+        """
+        def in_bounds(o):
+            for n, (low, high) in bounds.items():
+                value = getattr(o, n, None)
+                if value is None or \
+                        (low is not None and value < low) or \
+                        (high is not None and value > high):
+                    return False
+            return True
+
+        candidates = [self._candidates(n, lambda i: i.ordered,
+                                       lambda i, b=b: i.find_range(*b))
+                      for n, b in bounds.items()]
+        return self._query(
+            [c for c in candidates if c is not None], in_bounds)
+
+    def clashes(self, obj: DistributedObject, data: dict) -> List:
+        """The other objects already holding unique values that obj would
+        take on from data.
+        """
+        found = {}
+        for name, index in self._class_indexes.get(obj.__class__, {}).items():
+            if index.unique and name in data:
+                found.update(index.find(data[name]))
+        found.pop(obj.id, None)
+        return list(found.values())
+
+    def _candidates(self, name: str, usable, lookup):
+        """Every object that might match on one field, by id: what lookup
+        finds in each usable index of that field, plus all objects of
+        classes without one. None if no class has a usable index for it.
+        """
+        found, searched = [], set()
+        for cls, objects in self._by_class.items():
+            index = self._class_indexes[cls].get(name)
+            if index is None or not usable(index):
+                found.append(objects)
+            elif id(index) not in searched:
+                searched.add(id(index))
+                found.append(lookup(index))
+        if not searched:
+            return None
+        if len(found) == 1:
+            return found[0]
+        merged = {}
+        for objects in found:
+            merged.update(objects)
+        return merged
+
+    def _query(self, candidates: List[dict], matches) -> List:
+        if not candidates:
+            # Nothing indexed; check every object
+            return [o for o in self._instances.values() if matches(o)]
+        smallest = min(candidates, key=len)
+        return [o for o in smallest.values() if matches(o)]
+
+    def _add_keyframes(self, obj: DistributedObject, data: dict):
+        if self.clock is None or not obj._interpolated_fields:
+            return
+        now = self.clock()
+        buffers = self._keyframes.setdefault(obj.id, {})
+        for name in obj._interpolated_fields:
+            if name not in data:
+                continue
+            buffer = buffers.get(name)
+            if buffer is None:
+                buffer = buffers[name] = KeyframeBuffer(
+                    self.keyframes, self.max_extrapolation)
+            buffer.add(now, data[name])
+
+    def value_at(self, object_id: str, name: str, time: float):
+        """An interpolated field's value at a time, or None without any
+        keyframes for it.
+        """
+        buffer = self._keyframes.get(object_id, {}).get(name)
+        return buffer.value_at(time) if buffer else None
+
+    def _add_indexes(self, cls):
+        """Find or make the index of every indexed field of a newly seen
+        class. Each index belongs to the class that declared the field.
+        """
+        indexes = self._class_indexes[cls] = {}
+        for name in cls._indexed_fields:
+            field = cls._fields[name]
+            # The furthest ancestor declaring this very Field
+            declared_by = next(c for c in reversed(cls.__mro__)
+                               if getattr(c, '_fields', {}).get(name) is field)
+            index = self._indexes.get((declared_by, name))
+            if index is None:
+                index = self._indexes[declared_by, name] = FieldIndex(
+                    name, unique=field.unique, ordered=field.sorted)
+            indexes[name] = index
+
+    def _index(self, obj: DistributedObject):
+        indexes = self._class_indexes[obj.__class__]
+        values = [(i, getattr(obj, n)) for n, i in indexes.items()]
+        # Check everything first so a unique clash changes nothing
+        for index, value in values:
+            index.check(obj.id, value)
+        for index, value in values:
+            index.add(obj, value)
+
+    def _check(self, obj: DistributedObject, data: dict):
+        for name, index in self._class_indexes[obj.__class__].items():
+            if name in data:
+                index.check(obj.id, data[name])
+
+    def _reindex(self, obj: DistributedObject):
+        """Called by objects after their values change."""
+        self._index(obj)
+        self._refile(obj)
+
+    def _file(self, obj: DistributedObject):
+        key = (obj.owner, obj.zone)
+        self._filed_under[obj.id] = key
+        self._by_owner[key[0]][obj.id] = obj
+        self._by_zone[key[1]][obj.id] = obj
+
+    def _unfile(self, obj_id: str):
+        owner, zone = self._filed_under.pop(obj_id)
+        self._remove_from(self._by_owner, owner, obj_id)
+        self._remove_from(self._by_zone, zone, obj_id)
+
+    def _refile(self, obj: DistributedObject):
+        """Move the object if its owner or zone has changed."""
+        if self._filed_under.get(obj.id) != (obj.owner, obj.zone):
+            self._unfile(obj.id)
+            self._file(obj)
+
+    @staticmethod
+    def _remove_from(partition: dict, key, obj_id: str):
+        objects = partition[key]
+        del objects[obj_id]
+        if not objects:
+            del partition[key]
+
     def get(self, object_id, default=None):
-        try:
-            return self[object_id]
-        except IndexError:
-            return default
+        return self._instances.get(object_id, default)
 
     def __getitem__(self, object_id: str):
-        for o in self._instances:
-            if o.id == object_id:
-                return o
-        raise IndexError(
-            "{} ".format(object_id))
+        try:
+            return self._instances[object_id]
+        except KeyError:
+            raise IndexError(
+                "{} ".format(object_id))
 
     def __len__(self):
         return len(self._instances)
 
     def __iter__(self):
-        return iter(self._instances)
\ No newline at end of file
+        return iter(list(self._instances.values()))
@@ -0,0 +1,90 @@
+# coding=utf-8
+"""Field indexes kept by DistributedObjectState for `where` and `range`
+queries. Fields opt in with Field(..., index=True), unique=True or
+sorted=True.
+"""
+from bisect import bisect_left, bisect_right, insort
+
+
+class UniqueError(ValueError):
+    """A value is already used by another object in a unique index."""
+    pass
+
+
+class FieldIndex:
+    """Maps the values of one field to the objects holding them.
+
+    Equality lookups always go through a hash map. A sorted index also keeps
+    an ordered list of (value, id) pairs for range lookups; None values are
+    left out of it since they can't be compared.
+    """
+    def __init__(self, name: str, unique=False, ordered=False):
+        self.name = name
+        self.unique = unique
+        self.ordered = False
+        self._objects = {}  # value -> {id: object}
+        self._values = {}  # id -> value it's indexed under
+        self._sorted = []  # (value, id), only when ordered
+        if ordered:
+            self.make_ordered()
+
+    def make_ordered(self):
+        """Start keeping the sorted list, building it from what's indexed."""
+        if self.ordered:
+            return
+        self.ordered = True
+        self._sorted = sorted(
+            (v, i) for i, v in self._values.items() if v is not None)
+
+    def check(self, obj_id: str, value):
+        """Raise if indexing this value would break uniqueness."""
+        if not self.unique:
+            return
+        holders = self._objects.get(value, {})
+        if holders and obj_id not in holders:
+            raise UniqueError("{} must be unique; {!r} is already used".format(
+                self.name, value))
+
+    def add(self, obj, value):
+        """Index the object under value, moving it if it was elsewhere."""
+        if obj.id in self._values:
+            if self._values[obj.id] == value:
+                return
+            self.remove(obj.id)
+        self.check(obj.id, value)
+        self._values[obj.id] = value
+        self._objects.setdefault(value, {})[obj.id] = obj
+        if self.ordered and value is not None:
+            insort(self._sorted, (value, obj.id))
+
+    def remove(self, obj_id: str):
+        value = self._values.pop(obj_id, None)
+        holders = self._objects.get(value)
+        if holders is None or obj_id not in holders:
+            return
+        del holders[obj_id]
+        if not holders:
+            del self._objects[value]
+        if self.ordered and value is not None:
+            del self._sorted[bisect_left(self._sorted, (value, obj_id))]
+
+    def find(self, value) -> dict:
+        """Every object with exactly this value, by id."""
+        return self._objects.get(value, {})
+
+    def find_range(self, low=None, high=None) -> dict:
+        """Every object with low <= value <= high, by id. Either bound may be
+        None to leave that end open.
+        """
+        if not self.ordered:
+            raise ValueError("{} has no sorted index".format(self.name))
+        start = 0 if low is None else bisect_left(self._sorted, (low,))
+        if high is None:
+            end = len(self._sorted)
+        else:
+            # Every (high, id) pair sorts before (high, <anything longer>)
+            end = bisect_right(self._sorted, (high, chr(0x10ffff)))
+        return {i: self._objects[v][i] for v, i in self._sorted[start:end]}
+
+    def __len__(self):
+        return len(self._values)
@@ -0,0 +1,158 @@
+# coding=utf-8
+"""Area of interest on a grid of zones.
+
+A Grid splits the world's x/y plane into square cells, and each cell is a
+zone of its own. Objects live in the cell under them (set their zone with
+Grid.cell), and a zone server owns a block of cells (see PastryZone.cells).
+Clients use GridInterest to stay joined to the cells around their avatar.
+
+Moving an object between cells is just a change of its zone. Listeners on
+the old cell get the update, then the zone server that owned the object
+sends an `enter` to the new cell and forgets it. The zone server owning the
+new cell takes it over, and agents pass the enter on as a new object to
+clients that weren't watching the old cell. The mover's next updates go
+straight to the new cell and can get there before the enter, so zones and
+clients keep them a while in EarlyUpdates.
+"""
+from collections import OrderedDict
+
+
+class Grid:
+    """Square cells of cell_size world units. A client is interested in every
+    cell within radius cells of its own, counting diagonals.
+    """
+    def __init__(self, name: str, cell_size: float, radius=1):
+        self.name = name
+        self.cell_size = cell_size
+        self.radius = radius
+
+    def coordinates(self, x: float, y: float) -> tuple:
+        """The column and row of the cell holding a position."""
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def cell(self, x: float, y: float) -> str:
+        """The zone id of the cell holding a position."""
+        return self._zone_id(*self.coordinates(x, y))
+
+    def _zone_id(self, column: int, row: int) -> str:
+        return "{}:{}:{}".format(self.name, column, row)
+
+    def neighborhood(self, x: float, y: float) -> set:
+        """The zone ids of every cell within radius of a position."""
+        column, row = self.coordinates(x, y)
+        r = self.radius
+        return {self._zone_id(column + i, row + j)
+                for i in range(-r, r + 1) for j in range(-r, r + 1)}
+
+    def cells_in(self, min_x: float, min_y: float,
+                 max_x: float, max_y: float) -> list:
+        """The zone ids of every cell overlapping a rectangle, for a zone
+        server to declare as its cells.
+        """
+        (x0, y0), (x1, y1) = (self.coordinates(min_x, min_y),
+                              self.coordinates(max_x, max_y))
+        return [self._zone_id(i, j)
+                for i in range(x0, x1 + 1) for j in range(y0, y1 + 1)]
+
+
+class GridInterest:
+    """Keeps a client joined to the cells around a position. Call move()
+    whenever the avatar moves; it only joins and leaves the cells that
+    changed, and does nothing until the avatar crosses into another cell.
+
+    Example usage:
+    self.interest = GridInterest(self, OVERWORLD)
+    self.interest.move(avatar.x, avatar.y)
+    """
+    def __init__(self, client, grid: Grid):
+        self.client = client
+        self.grid = grid
+        self.cells = set()
+        self._center = None
+
+    def move(self, x: float, y: float):
+        center = self.grid.coordinates(x, y)
+        if center == self._center:
+            return
+        self._center = center
+        cells = self.grid.neighborhood(x, y)
+        # Join first, so objects crossing between cells aren't missed
+        for zone in cells - self.cells:
+            self.client.subscribe(zone)
+        for zone in self.cells - cells:
+            self.client.unsubscribe(zone)
+        self.cells = cells
+
+    def clear(self):
+        """Leave every cell."""
+        for zone in self.cells:
+            self.client.unsubscribe(zone)
+        self.cells = set()
+        self._center = None
+
+
+class EarlyUpdates:
+    """Updates that arrived on a zone for objects we don't have there yet,
+    such as one still entering it from another cell. They're kept for
+    timeout seconds in case the object turns up.
+
+    Updates for an object that just left a zone are still on their way to
+    it for a moment. Call left() when an object leaves, and those are
+    turned away for the same timeout rather than kept and replayed should
+    it come back.
+    """
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        # (zone, object id) -> (held since, [payload, ...])
+        self._held = OrderedDict()
+        self._left = OrderedDict()  # (zone, object id) -> when it left
+
+    def hold(self, zone: str, object_id: str, payload: bytes,
+             now: float) -> list:
+        """Keep an update. Returns the (zone, object id) pairs whose updates
+        were held too long and have now been dropped.
+        """
+        expired = self._expire(now)
+        key = (zone, object_id)
+        if key not in self._left:
+            self._held.setdefault(key, (now, []))[1].append(payload)
+        return expired
+
+    def take(self, zone: str, object_id: str) -> list:
+        """Every update kept for the object in a zone, oldest first,
+        forgetting them.
+        """
+        self._left.pop((zone, object_id), None)
+        return self._held.pop((zone, object_id), (None, []))[1]
+
+    def left(self, zone: str, object_id: str, now: float):
+        """Turn away updates for an object that just left a zone."""
+        self._forget_left(now)
+        key = (zone, object_id)
+        self._held.pop(key, None)
+        self._left.pop(key, None)
+        self._left[key] = now
+
+    def forget_zone(self, zone: str):
+        """Drop everything kept for a zone we've stopped watching."""
+        for key in [k for k in self._held if k[0] == zone]:
+            del self._held[key]
+
+    def _expire(self, now: float) -> list:
+        self._forget_left(now)
+        expired = []
+        while self._held:
+            oldest, (since, _) = next(iter(self._held.items()))
+            if now - since < self.timeout:
+                break
+            del self._held[oldest]
+            expired.append(oldest)
+        return expired
+
+    def _forget_left(self, now: float):
+        while self._left and \
+                now - next(iter(self._left.values())) >= self.timeout:
+            self._left.popitem(last=False)
+
+    def __len__(self):
+        return len(self._held)
@@ -0,0 +1,58 @@
+# coding=utf-8
+"""Keyframes for fields declared with Field(float, interpolate=True).
+
+A client's DistributedObjectState records each value such a field takes on,
+stamped with when it arrived. Game code then asks for the value at a render
+time a little in the past (see PastryClient.render_time) and gets a smooth
+path between the updates, even when the server only sends a few per second.
+"""
+from bisect import bisect_right
+
+
+class KeyframeBuffer:
+    """The last few (time, value) keyframes of one field of one object.
+
+    Between keyframes the value is interpolated linearly. Past the newest one
+    it keeps moving at the last known rate for up to max_extrapolation
+    seconds, then holds still until the next update arrives.
+    """
+    def __init__(self, size=8, max_extrapolation=0.25):
+        self.size = size
+        self.max_extrapolation = max_extrapolation
+        self._times = []
+        self._values = []
+
+    def add(self, time: float, value: float):
+        if value is None:
+            return
+        if self._times and time < self._times[-1]:
+            time = self._times[-1]  # The clock is never allowed to run back
+        self._times.append(time)
+        self._values.append(value)
+        if len(self._times) > self.size:
+            del self._times[0], self._values[0]
+
+    def value_at(self, time: float):
+        """The interpolated value at a time, or None if nothing's known."""
+        times, values = self._times, self._values
+        if not times:
+            return None
+        i = bisect_right(times, time)
+        if i == 0:
+            return values[0]
+        if i < len(times):
+            t0, t1 = times[i - 1], times[i]
+            v0, v1 = values[i - 1], values[i]
+        else:
+            if len(times) < 2:
+                return values[-1]
+            # Extrapolate from the last two keyframes
+            t0, t1 = times[-2], times[-1]
+            v0, v1 = values[-2], values[-1]
+            time = min(time, t1 + self.max_extrapolation)
+        if t1 == t0:
+            return v1
+        return v0 + (v1 - v0) * (time - t0) / (t1 - t0)
+
+    def __len__(self):
+        return len(self._times)
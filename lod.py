@@ -0,0 +1,216 @@
+# coding=utf-8
+"""Network level of detail: the agent sends updates for far away objects to
+each client less often than updates for nearby ones.
+
+NetworkLOD watches the creates and updates an agent relays to learn where
+objects are and who owns them. A client's focus is its avatar, the first
+object it owns that has a position. Each update is then either sent right
+away or held for that client until its object's interval has passed; a
+newer update for a held object is merged into it, so the client always gets
+the newest values once the hold is up.
+
+The agent tells it which zones it routes (watch and unwatch), and anything
+it knows about objects in a zone no client watches any more is dropped, as
+is what it knows about a connection's objects in a zone it leaves.
+"""
+from collections import defaultdict
+from math import hypot
+
+from protocol import decode_batch, decode_enter, decode_snapshot
+from schema import peek_id
+
+
+class _Tracked:
+    """What the agent knows about one object."""
+    __slots__ = ('cls', 'owner', 'zone', 'position')
+
+    def __init__(self, cls, owner, zone, position):
+        self.cls = cls
+        self.owner = owner
+        self.zone = zone
+        self.position = position  # None until every axis is known
+
+
+class NetworkLOD:
+    """Decides how often each client hears about each object.
+
+    tiers is a list of (distance, seconds) pairs: objects up to that far from
+    a client's avatar are updated at most once per that many seconds. A
+    distance of None matches anything farther. Objects with no known
+    position, and clients with no avatar, are never held back.
+    """
+    def __init__(self, registry, tiers, position_fields=("x", "y")):
+        self.registry = registry
+        self.tiers = sorted(tiers, key=lambda t: float("inf")
+                            if t[0] is None else t[0])
+        self.position_fields = tuple(position_fields)
+        self._objects = {}  # object id -> _Tracked
+        self._avatars = {}  # owner id -> object id of their avatar
+        self._zones = set()  # Zones the agent routes to clients
+        # connection -> {object id: [target, payload, time it's due]}
+        self._held = defaultdict(dict)
+        # connection -> {object id: when it last got an update}
+        self._sent = defaultdict(dict)
+        # object id -> connections with an entry in _sent or _held
+        self._receivers = defaultdict(set)
+
+    def observe(self, channel, message: bytes):
+        """Learn from an internal message on its way to clients."""
+        if channel.method == "create":
+            self._track(int(channel.code_name), message)
+        elif channel.method == "update":
+            self._track_update(message)
+        elif channel.method == "delete":
+            self._forget(peek_id(message))
+        elif channel.method == "batch":
+            for c, m in decode_batch(channel, message):
+                self.observe(c, m)
+        elif channel.method == "snapshot":
+            for class_id, payload in decode_snapshot(message):
+                self._track(class_id, payload)
+        elif channel.method == "enter":
+            self._track(int(channel.code_name), decode_enter(message)[1])
+
+    def watch(self, zone: str):
+        """The agent started routing a zone to its clients."""
+        self._zones.add(zone)
+
+    def unwatch(self, zone: str):
+        """No client of the agent watches a zone any more; forget the
+        objects in it.
+        """
+        self._zones.discard(zone)
+        for object_id in [i for i, t in self._objects.items()
+                          if t.zone == zone]:
+            self._forget(object_id)
+
+    def leave(self, connection, zone: str):
+        """A connection stopped watching a zone; forget when it was last
+        sent, or is being held, the objects in it.
+        """
+        held, sent = self._held.get(connection), self._sent.get(connection)
+        for object_id in list(sent or ()) + list(held or ()):
+            tracked = self._objects.get(object_id)
+            if tracked is None or tracked.zone == zone:
+                self._forget_for(connection, object_id)
+
+    def _track(self, class_id: int, payload):
+        cls = self.registry[class_id]
+        data = cls._schema.decode(payload)
+        if data.get('zone') not in self._zones:
+            return
+        tracked = _Tracked(cls, data.get('owner'), data.get('zone'), None)
+        self._objects[data['id']] = tracked
+        self._place(data['id'], tracked, data)
+
+    def _track_update(self, payload: bytes):
+        object_id = peek_id(payload)
+        tracked = self._objects.get(object_id)
+        if tracked is None:
+            return
+        data = tracked.cls._schema.decode(payload)
+        if 'zone' in data:
+            if data['zone'] not in self._zones:
+                # Moved out of sight; an enter brings it back if need be
+                self._forget(object_id)
+                return
+            tracked.zone = data['zone']
+        if 'owner' in data:
+            tracked.owner = data['owner']
+        self._place(object_id, tracked, data)
+
+    def _place(self, object_id: str, tracked: _Tracked, data: dict):
+        fields = self.position_fields
+        if not any(f in data for f in fields):
+            return
+        old = tracked.position or (None,) * len(fields)
+        position = tuple(data.get(f, o) for f, o in zip(fields, old))
+        tracked.position = None if None in position else position
+        if tracked.position is not None and tracked.owner:
+            self._avatars.setdefault(tracked.owner, object_id)
+
+    def _forget(self, object_id: str):
+        tracked = self._objects.pop(object_id, None)
+        if tracked is not None and \
+                self._avatars.get(tracked.owner) == object_id:
+            del self._avatars[tracked.owner]
+        for connection in self._receivers.pop(object_id, ()):
+            self._held[connection].pop(object_id, None)
+            self._sent[connection].pop(object_id, None)
+
+    def _forget_for(self, connection, object_id: str):
+        self._held.get(connection, {}).pop(object_id, None)
+        self._sent.get(connection, {}).pop(object_id, None)
+        receivers = self._receivers.get(object_id)
+        if receivers is not None:
+            receivers.discard(connection)
+            if not receivers:
+                del self._receivers[object_id]
+
+    def forget_connection(self, connection):
+        held = self._held.pop(connection, {})
+        sent = self._sent.pop(connection, {})
+        for object_id in set(held) | set(sent):
+            receivers = self._receivers.get(object_id)
+            if receivers is not None:
+                receivers.discard(connection)
+                if not receivers:
+                    del self._receivers[object_id]
+
+    def interval(self, user_id: str, object_id: str) -> float:
+        """The fewest seconds between updates of an object for a user.
+        Override this to measure relevance some other way.
+        """
+        avatar = self._objects.get(self._avatars.get(user_id))
+        tracked = self._objects.get(object_id)
+        if avatar is None or tracked is None or tracked.position is None:
+            return 0
+        distance = hypot(*(a - b for a, b in zip(
+            avatar.position, tracked.position)))
+        for limit, seconds in self.tiers:
+            if limit is None or distance <= limit:
+                return seconds
+        return 0
+
+    def hold(self, connection, target: str, payload: bytes,
+             now: float) -> bool:
+        """Return whether this update should wait instead of being sent to
+        the connection now. Held updates come back out of due().
+        """
+        object_id = peek_id(payload)
+        held = self._held[connection].get(object_id)
+        if held is not None:
+            held[1] = self._merge(object_id, held[1], payload)
+            return True
+        seconds = self.interval(connection.id, object_id)
+        if not seconds:
+            return False
+        sent = self._sent[connection]
+        last = sent.get(object_id)
+        self._receivers[object_id].add(connection)
+        if last is None or now - last >= seconds:
+            sent[object_id] = now
+            return False
+        self._held[connection][object_id] = [target, payload, last + seconds]
+        return True
+
+    def _merge(self, object_id: str, old: bytes, new: bytes) -> bytes:
+        """One update carrying the newest value of every field in both."""
+        tracked = self._objects.get(object_id)
+        if tracked is None:
+            return new  # Deleted; the client will ignore it anyway
+        schema = tracked.cls._schema
+        data = schema.decode(old)
+        data.update(schema.decode(new))
+        return schema.encode(data)
+
+    def due(self, now: float):
+        """Yield (connection, target, payload) for every held update whose
+        wait is over.
+        """
+        for connection, held in self._held.items():
+            ready = [i for i, (_, _, when) in held.items() if when <= now]
+            for object_id in ready:
+                target, payload, _ = held.pop(object_id)
+                self._sent[connection][object_id] = now
+                yield connection, target, payload
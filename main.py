@@ -10,6 +10,8 @@ from client import PastryClient
 from distributed_objects import DistributedObject, Field, \
     DistributedObjectClassRegistry
 from multiserver import MultiServer
+from supervisor import Supervisor
+from transports import LocalTransport
 from zone import PastryZone
 
 
@@ -51,11 +53,12 @@ class ChatAgent(PastryAgent):
 
     log_color = "\033[93m"
     log_name = "Agent"
+    # So `server N` can run N agents on the one port
+    reuse_port = True
 
-    def _authenticate(self, *args, **kwargs):
-        # TODO: I think this should return the user's token? Ideally, that's
-        # never disclosed.
-        return True
+    async def validate_credentials(self, credentials: dict) -> str:
+        # TODO: Check real credentials; for the demo everyone gets a fresh id
+        return str(uuid4())
 
 
 class ChatZone(PastryZone):
@@ -80,9 +83,14 @@ class ChatZone(PastryZone):
 if __name__ == "__main__":
     thing = sys.argv[1]
     if thing == 'server':
-        to_start = MultiServer(ChatZone, ChatAgent)
+        # Optionally run several agent processes sharing the port
+        agents = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        to_start = Supervisor(ChatZone, *[ChatAgent] * agents)
+    elif thing == 'local':
+        # Everything in one process with no Redis required
+        to_start = MultiServer(ChatZone, ChatAgent, transport=LocalTransport())
     elif thing == 'client':
         to_start = ChatClient()
     else:
-        raise ValueError('Must be `server` or `client`')
+        raise ValueError('Must be `server`, `local` or `client`')
     to_start.run()
@@ -2,16 +2,24 @@ import asyncio
 
 
 class MultiServer:
-    """Run several backend server instances in one go. You really shouldn't
-    use this in production, but it's quite useful in development.
+    """Run several backend server instances in one go, on one event loop.
+    You really shouldn't use this in production, where supervisor.Supervisor
+    gives each server a process of its own, but it's quite useful in
+    development.
+
+    Pass a shared LocalTransport to have the servers talk to each other in
+    memory instead of through Redis.
 
     Example usage:
     m = MultiServer(MyZone1, MyZone2, MyZone3, MyAgent)
     m.run()
+    m = MultiServer(MyZone1, MyAgent, transport=LocalTransport())
+    m.run()
     """
-    def __init__(self, *server_classes):
+    def __init__(self, *server_classes, transport=None):
         self._loop = asyncio.get_event_loop()
-        self.servers = [c(loop=self._loop) for c in server_classes]
+        self.servers = [c(loop=self._loop, transport=transport)
+                        for c in server_classes]
 
     def run(self):
         """Start each server process then run a complete event loop."""
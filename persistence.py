@@ -0,0 +1,147 @@
+# coding=utf-8
+"""Write-behind persistence of fields declared with Field(..., db=True).
+
+Saving an object only marks it dirty. Every so often the zone flushes the
+dirty objects, and they're written to SQLite in one transaction on a worker
+thread, so the event loop never waits on the disk. Each object is stored as
+JSON of its id, owner, zone and db fields, under the zone server that saved
+it, which is where it's loaded from again on startup. Objects whose write
+fails are written again at the next flush.
+"""
+import json
+import queue
+import sqlite3
+from base64 import b64decode, b64encode
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_ALWAYS_STORED = ('id', 'owner', 'zone')
+
+
+def _to_json(t, value):
+    if value is None:
+        return None
+    if t is bytes:
+        return b64encode(value).decode('ascii')
+    if t in (tuple, set, frozenset):
+        return list(value)
+    return value
+
+
+def _from_json(t, value):
+    if value is None:
+        return None
+    if t is bytes:
+        return b64decode(value)
+    if t in (tuple, set, frozenset, float):
+        return t(value)
+    return value
+
+
+class SQLiteStore:
+    """The persisted objects of one zone server, in a SQLite file."""
+    def __init__(self, path: str, server: str, registry):
+        self.path = path
+        self.server = server
+        self.registry = registry
+        self._dirty = {}  # id -> object, or None if it was deleted
+        self._failed = queue.SimpleQueue()  # Dirty dicts that didn't write
+        # One worker, so writes happen in order and sqlite3 connections
+        # stay on the thread that made them
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._db = None  # Only used on the worker thread
+
+    def mark(self, obj, deleted=False):
+        """Remember to write (or delete) the object at the next flush."""
+        self._dirty[obj.id] = None if deleted else obj
+
+    def flush(self) -> Future:
+        """Encode every dirty object now and write them in the background.
+        Returns the future of the write, if there was anything to write.
+        """
+        self._retry_failed()
+        if not self._dirty:
+            return None
+        dirty = self._dirty
+        rows, deleted = [], []
+        for obj_id, obj in dirty.items():
+            if obj is None:
+                deleted.append((obj_id,))
+                continue
+            saved, fields = obj._saved_field_data, obj._fields
+            data = {n: _to_json(fields[n].t, saved.get(n))
+                    for n in _ALWAYS_STORED + obj._db_fields}
+            rows.append((obj_id, self.server, obj.__class__.__name__,
+                         json.dumps(data)))
+        self._dirty = {}
+        return self._executor.submit(self._write, rows, deleted, dirty)
+
+    def _retry_failed(self):
+        """Mark the objects of failed writes dirty again, unless they've
+        been marked since.
+        """
+        while True:
+            try:
+                dirty = self._failed.get_nowait()
+            except queue.Empty:
+                return
+            for obj_id, obj in dirty.items():
+                self._dirty.setdefault(obj_id, obj)
+
+    def load(self) -> Future:
+        """Read back every object this server stored, off the event loop.
+        The future's result is a list of (class name, JSON data) rows.
+        """
+        return self._executor.submit(self._read)
+
+    def decode(self, rows) -> list:
+        """Build unsaved objects from rows returned by load()."""
+        objects = []
+        for class_name, data in rows:
+            cls = self.registry[class_name]
+            fields = cls._fields
+            values = {n: _from_json(fields[n].t, v)
+                      for n, v in json.loads(data).items() if n in fields}
+            objects.append(cls(**values))
+        return objects
+
+    def close(self) -> Future:
+        """Write whatever's left and wait for the worker to finish. Returns
+        the future of that last write, if there was one.
+        """
+        write = self.flush()
+        self._executor.submit(self._disconnect)
+        self._executor.shutdown(wait=True)
+        return write
+
+    # Everything below runs on the worker thread
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                "id TEXT PRIMARY KEY, server TEXT, class TEXT, data TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS objects_server "
+                             "ON objects (server)")
+        return self._db
+
+    def _write(self, rows: list, deleted: list, dirty: dict):
+        try:
+            db = self._connect()
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO objects VALUES (?,?,?,?)", rows)
+                db.executemany("DELETE FROM objects WHERE id = ?", deleted)
+        except Exception:
+            self._failed.put(dirty)
+            raise
+
+    def _read(self) -> list:
+        return self._connect().execute(
+            "SELECT class, data FROM objects WHERE server = ?",
+            (self.server,)).fetchall()
+
+    def _disconnect(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,215 @@
+# coding=utf-8
+"""The binary frame format spoken between PastryClient and PastryAgent.
+
+Every message after authentication is one frame:
+
+FIELD:          TYPE:               NOTES:
+Length          uint32              Size of everything after this field
+Version         uint8               PROTOCOL_VERSION
+Method          uint8               A util.Method code
+Class id        uint16              Registry id on `create`, otherwise 0
+Target length   uint16              Size of the target in bytes
+Target          utf8                The zone or user id
+Payload         bytes               The rest of the frame
+
+All integers are big-endian. Frames are length prefixed, so payloads may
+contain any characters and may arrive split across several reads.
+
+A `batch` payload (internally or in a frame) packs several messages for the
+same target, each as: method (uint8), class id (uint16), payload length
+(uint32), payload.
+
+A `snapshot` payload carries serialized objects for a joining client: a
+flags byte, then entries of class id (uint16), payload length (uint32) and
+payload. If the flags say so, the entries are zlib compressed.
+
+An `enter` payload (internal only) is the zone the object moved from as
+uint16 length and utf8, then the object's create payload.
+"""
+import struct
+import zlib
+
+from settings import MAX_FRAME_SIZE
+from util import Channel, Method
+
+PROTOCOL_VERSION = 1
+
+_LENGTH = struct.Struct("!I")
+_HEADER = struct.Struct("!BBHH")  # version, method, class id, target length
+_BATCH_ENTRY = struct.Struct("!BHI")  # method, class id, payload length
+_SNAPSHOT_ENTRY = struct.Struct("!HI")  # class id, payload length
+_SNAPSHOT_FLAGS = struct.Struct("!B")
+_ZONE_LENGTH = struct.Struct("!H")
+SNAPSHOT_COMPRESSED = 1
+
+
+class ProtocolError(ValueError):
+    """The peer sent something that is not a valid frame, or we were asked
+    to send something that can't be framed.
+    """
+    pass
+
+
+def _method_code(channel: Channel) -> int:
+    # The wire has a class id where a `call` would need its method name
+    if channel.method == "call":
+        raise ProtocolError("`call` channels can't be framed yet: {}".format(
+            channel))
+    return Method.from_name(channel.method)
+
+
+def encode_frame(channel: Channel, payload: bytes, registry) -> bytes:
+    """Pack a channel and its payload into a single frame."""
+    method = _method_code(channel)
+    class_id = 0
+    if channel.code_name:
+        class_id = registry.class_id(channel.code_name)
+    target = channel.target.encode('utf8')
+    header = _HEADER.pack(PROTOCOL_VERSION, method, class_id, len(target))
+    return b"".join((
+        _LENGTH.pack(len(header) + len(target) + len(payload)),
+        header, target, payload))
+
+
+def encode_batch(messages, chunk_size: int) -> list:
+    """Pack (Channel, payload) pairs for one target into batch payloads of
+    at most about chunk_size bytes each, keeping their order. Keep
+    chunk_size well under MAX_FRAME_SIZE so every batch fits in a frame.
+    """
+    batches, parts, size = [], [], 0
+    for channel, payload in messages:
+        entry_size = _BATCH_ENTRY.size + len(payload)
+        if parts and size + entry_size > chunk_size:
+            batches.append(b"".join(parts))
+            parts, size = [], 0
+        parts.append(_BATCH_ENTRY.pack(
+            _method_code(channel),
+            int(channel.code_name) if channel.code_name else 0,
+            len(payload)))
+        parts.append(payload)
+        size += entry_size
+    if parts:
+        batches.append(b"".join(parts))
+    return batches
+
+
+def decode_batch(channel: Channel, payload: bytes) -> list:
+    """Unpack a batch payload into the (Channel, payload) pairs it holds."""
+    messages = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        method, class_id, length = _BATCH_ENTRY.unpack_from(view, offset)
+        offset += _BATCH_ENTRY.size
+        messages.append((
+            Channel(target=channel.target, method=str(Method(method)),
+                    code_name=str(class_id) if class_id else None),
+            bytes(view[offset:offset + length])))
+        offset += length
+    return messages
+
+
+def encode_snapshot(objects, chunk_size: int, compress=True) -> list:
+    """Pack (class id, serialized object) pairs into snapshot payloads of
+    roughly chunk_size bytes each, before compression. Each one can be
+    applied on its own.
+    """
+    chunks, entries, size = [], [], 0
+    for class_id, payload in objects:
+        if entries and size + len(payload) > chunk_size:
+            chunks.append(_finish_snapshot(entries, compress))
+            entries, size = [], 0
+        entries.append(_SNAPSHOT_ENTRY.pack(class_id, len(payload)))
+        entries.append(payload)
+        size += _SNAPSHOT_ENTRY.size + len(payload)
+    if entries or not chunks:
+        chunks.append(_finish_snapshot(entries, compress))
+    return chunks
+
+
+def _finish_snapshot(entries: list, compress: bool) -> bytes:
+    body = b"".join(entries)
+    if compress:
+        return _SNAPSHOT_FLAGS.pack(SNAPSHOT_COMPRESSED) + \
+            zlib.compress(body, 1)
+    return _SNAPSHOT_FLAGS.pack(0) + body
+
+
+def decode_snapshot(payload: bytes) -> list:
+    """Unpack a snapshot payload into (class id, serialized object) pairs."""
+    (flags,) = _SNAPSHOT_FLAGS.unpack_from(payload)
+    body = payload[_SNAPSHOT_FLAGS.size:]
+    if flags & SNAPSHOT_COMPRESSED:
+        body = zlib.decompress(body)
+    objects = []
+    view = memoryview(body)
+    offset = 0
+    while offset < len(view):
+        class_id, length = _SNAPSHOT_ENTRY.unpack_from(view, offset)
+        offset += _SNAPSHOT_ENTRY.size
+        objects.append((class_id, view[offset:offset + length]))
+        offset += length
+    return objects
+
+
+def encode_enter(from_zone: str, payload: bytes) -> bytes:
+    """Pack the create payload of an object that moved in from from_zone."""
+    zone = from_zone.encode('utf8')
+    return _ZONE_LENGTH.pack(len(zone)) + zone + payload
+
+
+def decode_enter(payload: bytes) -> tuple:
+    """Unpack an enter payload into (zone moved from, create payload)."""
+    (length,) = _ZONE_LENGTH.unpack_from(payload)
+    end = _ZONE_LENGTH.size + length
+    return str(payload[_ZONE_LENGTH.size:end], 'utf8'), payload[end:]
+
+
+class FrameDecoder:
+    """Reassembles frames from a byte stream. Feed it whatever the socket
+    returns; it hands back every complete (Channel, payload) pair and keeps
+    any partial frame for the next call.
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        self._buffer += data
+        messages = []
+        offset = 0
+        # Slicing a memoryview doesn't copy, so the only copies made are the
+        # final target and payload extractions.
+        with memoryview(self._buffer) as view:
+            while len(view) - offset >= _LENGTH.size:
+                (length,) = _LENGTH.unpack_from(view, offset)
+                if not _HEADER.size <= length <= MAX_FRAME_SIZE:
+                    raise ProtocolError("Bad frame length {}".format(length))
+                end = offset + _LENGTH.size + length
+                if end > len(view):
+                    break  # Wait for the rest of this frame
+                messages.append(self._decode(view[offset + _LENGTH.size:end]))
+                offset = end
+        del self._buffer[:offset]
+        return messages
+
+    def _decode(self, frame: memoryview) -> tuple:
+        version, method, class_id, target_length = _HEADER.unpack_from(frame)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError("Unsupported protocol version {}".format(
+                version))
+        try:
+            method = Method(method)
+            code_name = None
+            if class_id:
+                # Make sure it's registered, but keep passing the id along
+                code_name = str(self.registry.class_id(class_id))
+        except (ValueError, IndexError) as exc:
+            raise ProtocolError(str(exc))
+
+        body = _HEADER.size + target_length
+        if body > len(frame):
+            raise ProtocolError("Target runs past the end of the frame")
+        channel = Channel(target=str(frame[_HEADER.size:body], 'utf8'),
+                          method=str(method), code_name=code_name)
+        return channel, bytes(frame[body:])
@@ -4,7 +4,18 @@ from distributed_objects import DistributedObject, Field
 class Character(DistributedObject):
     """Abstract class for characters."""
     # model_path = Field(str)
-    destination = Field(tuple)
+    # Centimeter precision is plenty, and sends each axis in 4 bytes
+    destination_x = Field(float, precision=0.01)
+    destination_y = Field(float, precision=0.01)
+    destination_z = Field(float, precision=0.01)
     # color = Field(str)
     # name = Field(str)
     # location_keyframes = Field(list)
+
+    @property
+    def destination(self):
+        return self.destination_x, self.destination_y, self.destination_z
+
+    @destination.setter
+    def destination(self, point):
+        self.destination_x, self.destination_y, self.destination_z = point
@@ -194,15 +194,13 @@ class ChessboardDemo(ShowBase):
         return Task.cont
 
     def piece_at(self, square):
-        for p in self.client.objects:
-            if p.square == square:
-                return p
+        for p in self.client.objects.where(square=square):
+            return p
         return None
 
     def model_at(self, square):
-        for p in self.client.objects:
-            if p.square == square:
-                return self.client.models[p.id]
+        for p in self.client.objects.where(square=square):
+            return self.client.models[p.id]
         return None
 
     def grab_piece(self):
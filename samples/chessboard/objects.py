@@ -3,7 +3,7 @@ from distributed_objects import DistributedObject, Field
 
 class Piece(DistributedObject):
     """An abstract class for pieces"""
-    square = Field(int)  # 0-63 represents all positions
+    square = Field(int, index=True)  # 0-63 represents all positions
     color = Field(str)
 
 
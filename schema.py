@@ -0,0 +1,180 @@
+# coding=utf-8
+"""Compact binary encoding of DistributedObject fields.
+
+Each DistributedObject class gets a Schema built by its metaclass from the
+declared Fields. A serialized object looks like this:
+
+FIELD:          TYPE:               NOTES:
+Id length       uint16
+Id              utf8                Always present, so it can be peeked
+Mask size       uint8               Bytes in each of the two masks
+Present mask    bitmask             One bit per field, in declaration order
+Null mask       bitmask             Present fields whose value is None
+Fixed block     struct              Every present int, float and bool field.
+                                    Floats with a precision are sent as
+                                    int32 multiples of it.
+Variable fields uint32 + bytes      Every present str, bytes or other field
+
+Field names never go over the wire; both ends must share the class
+definitions. Fields of any other type fall back to JSON.
+"""
+import json
+import struct
+
+_ID_LENGTH = struct.Struct("!H")
+_MASK_SIZE = struct.Struct("!B")
+_VARIABLE_LENGTH = struct.Struct("!I")
+
+# Fields of these types are packed together in the fixed block
+_FIXED_FORMATS = {int: "q", float: "d", bool: "?"}
+
+
+def _json_codec(property_type):
+    """Encoder and decoder for fields with no native binary form."""
+    if property_type in (set, frozenset):
+        def encode(value):
+            return json.dumps(list(value)).encode('utf8')
+    else:
+        def encode(value):
+            return json.dumps(value).encode('utf8')
+
+    if property_type in (tuple, list, set, frozenset):
+        # JSON only knows lists, so restore the declared container type
+        def decode(view):
+            return property_type(json.loads(str(view, 'utf8')))
+    else:
+        def decode(view):
+            return json.loads(str(view, 'utf8'))
+    return encode, decode
+
+
+def _variable_codec(property_type):
+    if property_type is str:
+        return (lambda value: value.encode('utf8'),
+                lambda view: str(view, 'utf8'))
+    if property_type is bytes:
+        return bytes, bytes
+    return _json_codec(property_type)
+
+
+def peek_id(payload) -> str:
+    """Read just the object id from a serialized object."""
+    (length,) = _ID_LENGTH.unpack_from(payload)
+    return str(memoryview(payload)[_ID_LENGTH.size:_ID_LENGTH.size + length],
+               'utf8')
+
+
+def peek_fields(payload) -> tuple:
+    """Read the object id and the bitmask of fields present, without knowing
+    the object's class.
+    """
+    view = memoryview(payload)
+    (length,) = _ID_LENGTH.unpack_from(view)
+    offset = _ID_LENGTH.size + length
+    object_id = str(view[_ID_LENGTH.size:offset], 'utf8')
+    (size,) = _MASK_SIZE.unpack_from(view, offset)
+    offset += _MASK_SIZE.size
+    return object_id, int.from_bytes(view[offset:offset + size], 'big')
+
+
+class Schema:
+    """Encodes and decodes the fields of one DistributedObject class. The
+    struct layout for each combination of present fields is worked out the
+    first time it's seen and cached from then on.
+    """
+    def __init__(self, classname: str, fields: dict):
+        self.classname = classname
+        # The id is always written first, so it's not part of the masks
+        self.names = [n for n in fields if n != 'id']
+        self.types = [fields[n].t for n in self.names]
+        self.precisions = [getattr(fields[n], 'precision', None)
+                           for n in self.names]
+        self._mask_size = max(1, (len(self.names) + 7) // 8)
+        self._layouts = {}
+
+    def _layout(self, mask: int) -> tuple:
+        layout = self._layouts.get(mask)
+        if layout is None:
+            fixed_format, fixed_names, variable = "!", [], []
+            quantized = []  # (position in the fixed block, precision)
+            for i, (name, t, precision) in enumerate(
+                    zip(self.names, self.types, self.precisions)):
+                if not mask & (1 << i):
+                    continue
+                if precision:
+                    quantized.append((len(fixed_names), precision))
+                    fixed_format += "i"
+                    fixed_names.append(name)
+                elif t in _FIXED_FORMATS:
+                    fixed_format += _FIXED_FORMATS[t]
+                    fixed_names.append(name)
+                else:
+                    variable.append((name, *_variable_codec(t)))
+            layout = (struct.Struct(fixed_format), fixed_names, quantized,
+                      variable)
+            self._layouts[mask] = layout
+        return layout
+
+    def encode(self, data: dict) -> bytes:
+        """Serialize the fields in data. It must contain the id."""
+        present = nulls = 0
+        for i, name in enumerate(self.names):
+            if name in data:
+                present |= 1 << i
+                if data[name] is None:
+                    nulls |= 1 << i
+        fixed, fixed_names, quantized, variable = \
+            self._layout(present & ~nulls)
+
+        object_id = data['id'].encode('utf8')
+        values = [data[n] for n in fixed_names]
+        try:
+            for i, precision in quantized:
+                values[i] = round(values[i] / precision)
+            fixed_block = fixed.pack(*values)
+        except struct.error as exc:
+            raise TypeError("Can't serialize {} fields {}: {}".format(
+                self.classname, fixed_names, exc))
+        parts = [_ID_LENGTH.pack(len(object_id)), object_id,
+                 _MASK_SIZE.pack(self._mask_size),
+                 present.to_bytes(self._mask_size, 'big'),
+                 nulls.to_bytes(self._mask_size, 'big'),
+                 fixed_block]
+        for name, encode, _ in variable:
+            raw = encode(data[name])
+            parts.append(_VARIABLE_LENGTH.pack(len(raw)))
+            parts.append(raw)
+        return b"".join(parts)
+
+    def decode(self, payload) -> dict:
+        """Deserialize a payload back into a dict of field values."""
+        view = memoryview(payload)
+        (length,) = _ID_LENGTH.unpack_from(view)
+        offset = _ID_LENGTH.size + length
+        data = {'id': str(view[_ID_LENGTH.size:offset], 'utf8')}
+
+        size = self._mask_size
+        offset += _MASK_SIZE.size
+        present = int.from_bytes(view[offset:offset + size], 'big')
+        nulls = int.from_bytes(view[offset + size:offset + 2 * size], 'big')
+        offset += 2 * size
+        if nulls:
+            for i, name in enumerate(self.names):
+                if nulls & (1 << i):
+                    data[name] = None
+
+        fixed, fixed_names, quantized, variable = \
+            self._layout(present & ~nulls)
+        values = fixed.unpack_from(view, offset)
+        if quantized:
+            values = list(values)
+            for i, precision in quantized:
+                values[i] *= precision
+        data.update(zip(fixed_names, values))
+        offset += fixed.size
+        for name, _, decode in variable:
+            (length,) = _VARIABLE_LENGTH.unpack_from(view, offset)
+            offset += _VARIABLE_LENGTH.size
+            data[name] = decode(view[offset:offset + length])
+            offset += length
+        return data
@@ -1 +1,8 @@
-MAX_PACKET_SIZE = 1024
+MAX_PACKET_SIZE = 65536  # Bytes requested from the socket per read
+MAX_FRAME_SIZE = 1 << 20  # Larger client frames are a protocol error
+# Per-client outbound queues on the agent. Past the high water mark a client
+# is considered slow and the agent's slow client policy kicks in, until the
+# queue drains below the low water mark. Past the limit it's always kicked.
+SEND_QUEUE_HIGH_WATER = 256 * 1024
+SEND_QUEUE_LOW_WATER = 64 * 1024
+SEND_QUEUE_LIMIT = 4 * 1024 * 1024
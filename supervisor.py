@@ -0,0 +1,161 @@
+# coding=utf-8
+"""Runs servers in worker processes, so a shard can use every core.
+
+Each group of server classes given to the Supervisor gets a process and an
+event loop of its own, and talks to the rest through its own Redis
+connection. Workers that die are restarted, backing off if they keep dying
+right away. Every so often each worker reports its CPU use and how many
+messages it has queued, and the supervisor logs them.
+
+Example usage:
+s = Supervisor(Overworld, (Tavern, Shop), MyAgent)
+s.run()
+"""
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+
+def _work(server_classes, reports, report_interval: float):
+    """The body of a worker process."""
+    # The supervisor decides when everyone stops, and says so with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    servers = [c(loop=loop) for c in server_classes]
+    for s in servers:
+        s.startup()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    reporter = loop.create_task(_report(servers, reports, report_interval))
+    try:
+        loop.run_forever()
+    finally:
+        reporter.cancel()
+        for s in servers:
+            s.shutdown()
+
+
+async def _report(servers, reports, interval: float):
+    pid = os.getpid()
+    while True:
+        await asyncio.sleep(interval)
+        reports.put_nowait((pid, time.process_time(),
+                            sum(s.queue_depth() for s in servers)))
+
+
+class _Worker:
+    """The supervisor's record of one worker process."""
+    def __init__(self, server_classes: tuple, delay: float):
+        self.server_classes = server_classes
+        self.name = "+".join(c.__name__ for c in server_classes)
+        self.process = None
+        self.started = 0.0
+        self.delay = delay  # Wait before the next restart
+        self.restart_at = 0.0
+        self.cpu = None  # (process time, wall time) as of the last report
+
+
+class Supervisor:
+    """Starts, watches and stops a worker process per group of servers. A
+    group is a server class, or a tuple of them to share one process.
+    """
+    log_color = "\033[95m"
+    log_name = "Supervisor"
+
+    restart_delay = 1.0
+    max_restart_delay = 30.0
+    stable_after = 10.0  # Workers up this long restart without backing off
+    report_interval = 10.0
+    shutdown_timeout = 10.0
+
+    def __init__(self, *groups):
+        self.workers = [
+            _Worker(tuple(g) if isinstance(g, (tuple, list)) else (g,),
+                    self.restart_delay)
+            for g in groups]
+        self._reports = multiprocessing.Queue()
+        self._stopping = False
+
+    def log(self, *messages):
+        message = " ".join(str(m) for m in messages)
+        print("{c}\033[1m{n: <16}\033[0m{m}".format(
+            c=self.log_color, n=self.log_name, m=message))
+
+    def run(self):
+        """Start every worker and look after them until interrupted."""
+        signal.signal(signal.SIGTERM, self._request_stop)
+        for w in self.workers:
+            self._start(w)
+        try:
+            while not self._stopping:
+                self._read_reports(timeout=0.5)
+                self._check_workers()
+        except KeyboardInterrupt:
+            print("\nKeyboard Interrupt: shutting down...")
+        self.shutdown()
+
+    def _request_stop(self, *args):
+        self._stopping = True
+
+    def _start(self, w: _Worker):
+        w.process = multiprocessing.Process(
+            target=_work, name=w.name,
+            args=(w.server_classes, self._reports, self.report_interval))
+        w.process.start()
+        w.started = time.monotonic()
+        w.cpu = None
+        self.log("Started {} (pid {})".format(w.name, w.process.pid))
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for w in self.workers:
+            if w.process is not None and not w.process.is_alive():
+                if now - w.started >= self.stable_after:
+                    w.delay = self.restart_delay
+                w.restart_at = now + w.delay
+                self.log("{} exited with code {}; restarting in {:.1f}s"
+                         .format(w.name, w.process.exitcode, w.delay))
+                # Keep backing off while it dies straight away
+                w.delay = min(w.delay * 2, self.max_restart_delay)
+                w.process = None
+            if w.process is None and now >= w.restart_at:
+                self._start(w)
+
+    def _read_reports(self, timeout: float):
+        """Log every report that's come in, waiting a while for the first."""
+        try:
+            report = self._reports.get(timeout=timeout)
+            while True:
+                self._log_report(*report)
+                report = self._reports.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _log_report(self, pid: int, cpu: float, queue_depth: int):
+        now = time.monotonic()
+        for w in self.workers:
+            if w.process is None or w.process.pid != pid:
+                continue
+            if w.cpu is not None:
+                last_cpu, last_time = w.cpu
+                percent = 100 * (cpu - last_cpu) / (now - last_time)
+                self.log("{} (pid {}): {:.0f}% CPU, {} queued".format(
+                    w.name, pid, percent, queue_depth))
+            w.cpu = (cpu, now)
+
+    def shutdown(self):
+        """Ask every worker to stop, and kill any that won't in time."""
+        running = [w.process for w in self.workers
+                   if w.process is not None and w.process.is_alive()]
+        for p in running:
+            p.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for p in running:
+            p.join(max(0.0, deadline - time.monotonic()))
+            if p.is_alive():
+                self.log("{} didn't stop in time; killing it".format(p.name))
+                p.kill()
+                p.join()
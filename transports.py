@@ -0,0 +1,206 @@
+# coding=utf-8
+"""Transports move internal messages between servers. Every
+InternalMessagingServer publishes and subscribes through exactly one of them.
+
+RedisTransport talks to a Redis pubsub server and is what a real deployment
+uses. LocalTransport is an in-memory bus for servers that share one event
+loop (see MultiServer); it hands the Channel and payload objects straight to
+the subscribers, so nothing is encoded or parsed on the way.
+"""
+
+import asyncio
+from collections import defaultdict
+
+import redis.asyncio as redis
+from util import Channel
+
+
+class Transport:
+    """The interface every transport implements."""
+
+    def attach(self, server) -> None:
+        """Called once by each server that will use this transport."""
+        raise NotImplementedError()
+
+    def publish(self, channel: Channel, message: bytes) -> None:
+        """Send a message on a channel to every subscribed server."""
+        raise NotImplementedError()
+
+    def subscribe(self, server, address: str) -> None:
+        """Deliver every message published on this address to server."""
+        raise NotImplementedError()
+
+    def unsubscribe(self, server, address: str) -> None:
+        """Stop delivering messages on this address to server."""
+        raise NotImplementedError()
+
+    def startup(self, loop) -> None:
+        """Start any worker tasks. May be called once per attached server."""
+        pass
+
+    def queue_depth(self) -> int:
+        """How many outgoing messages are waiting to be sent."""
+        return 0
+
+    def shutdown(self) -> None:
+        pass
+
+
+class RedisTransport(Transport):
+    """A Redis pubsub connection belonging to a single server.
+
+    Every subscription is to an exact channel name, so Redis never has to
+    match publishes against patterns. This talks to a single Redis server;
+    Redis Cluster (and its sharded pubsub) isn't supported.
+
+    If Redis goes away, both directions log it and keep retrying, backing
+    off up to max_retry_delay. Writes that failed are sent again, so a
+    publish can arrive twice around a reconnect.
+    """
+    server = None
+    retry_delay = 0.5
+    max_retry_delay = 30.0
+
+    def __init__(self, host='localhost', port=6379, db=0):
+        # Publishes and (un)subscriptions are queued here in order and written
+        # to Redis by a single task, since callers may not be coroutines.
+        self._outbox = asyncio.Queue()
+        # Publishing and subscribing draw separate connections from one pool,
+        # so a busy subscription never holds up outgoing messages.
+        self._redis_pool = redis.ConnectionPool(host=host, port=port, db=db)
+        self._redis = redis.StrictRedis(connection_pool=self._redis_pool)
+        self._pubsub = self._redis.pubsub()
+        self._tasks = []
+
+    def attach(self, server) -> None:
+        if self.server is not None:
+            raise ValueError("A RedisTransport can only serve one server.")
+        self.server = server
+        server.log("Connecting to Redis...")
+
+    def publish(self, channel: Channel, message: bytes) -> None:
+        self._outbox.put_nowait(
+            ("publish", channel.address, channel.pack(message)))
+
+    def subscribe(self, server, address: str) -> None:
+        self._outbox.put_nowait(("subscribe", address))
+
+    def unsubscribe(self, server, address: str) -> None:
+        self._outbox.put_nowait(("unsubscribe", address))
+
+    async def _redis_write(self):
+        """Flush everything queued in the outbox each time it wakes up.
+        Consecutive publishes share one pipelined round trip.
+        """
+        while True:
+            commands = [await self._outbox.get()]
+            while not self._outbox.empty():
+                commands.append(self._outbox.get_nowait())
+
+            delay = self.retry_delay
+            while True:
+                try:
+                    await self._write(commands)
+                    break
+                except (redis.RedisError, OSError) as exc:
+                    self.server.log("Redis write failed, retrying in "
+                                    "{:.1f}s: {!r}".format(delay, exc))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.max_retry_delay)
+
+    async def _write(self, commands: list):
+        pipe = self._redis.pipeline(transaction=False)
+        for command, *args in commands:
+            if command == "publish":
+                getattr(pipe, command)(*args)
+                continue
+            # Keep ordering: anything published before a subscription
+            # change must go out first.
+            if len(pipe):
+                await pipe.execute()
+            await getattr(self._pubsub, command)(*args)
+        if len(pipe):
+            await pipe.execute()
+
+    async def _redis_listen(self):
+        """Sleep until the subscription socket is readable, then handle every
+        message that has already arrived before waiting again.
+        """
+        delay = self.retry_delay
+        while True:
+            try:
+                # Reconnecting also renews every subscription
+                await self._pubsub.connect()
+                message = await self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=None)
+                while message:
+                    self._deliver(message['data'])
+                    message = await self._pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=0)
+                delay = self.retry_delay
+            except (redis.RedisError, OSError) as exc:
+                self.server.log("Lost Redis subscription, retrying in "
+                                "{:.1f}s: {!r}".format(delay, exc))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def _deliver(self, data: bytes):
+        """Hand one message to the server. A message it can't handle is
+        logged and dropped, so the rest keep flowing.
+        """
+        try:
+            channel, payload = Channel.unpack(data)
+            self.server._handle_internal_message(channel, payload)
+        except Exception as exc:
+            self.server.log("Couldn't handle a message: {!r}".format(exc))
+
+    def queue_depth(self) -> int:
+        return self._outbox.qsize()
+
+    def startup(self, loop) -> None:
+        self._tasks = [
+            asyncio.ensure_future(self._redis_write(), loop=loop),
+            asyncio.ensure_future(self._redis_listen(), loop=loop),
+        ]
+
+    def shutdown(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+
+
+class LocalTransport(Transport):
+    """An in-memory message bus shared by servers on the same event loop.
+
+    Example usage:
+    bus = LocalTransport()
+    m = MultiServer(MyZone, MyAgent, transport=bus)
+    """
+    def __init__(self):
+        self._loop = None
+        self._servers = []
+        self._subscribers = defaultdict(set)  # address -> {server, ...}
+
+    def attach(self, server) -> None:
+        self._servers.append(server)
+
+    def publish(self, channel: Channel, message: bytes) -> None:
+        # Deliver on the next loop iteration rather than re-entering the
+        # subscriber from inside the publisher. call_soon is FIFO, so the
+        # publish order is kept.
+        loop = self._loop or asyncio.get_event_loop()
+        for server in self._subscribers.get(channel.address, ()):
+            loop.call_soon(server._handle_internal_message, channel, message)
+
+    def subscribe(self, server, address: str) -> None:
+        self._subscribers[address].add(server)
+
+    def unsubscribe(self, server, address: str) -> None:
+        subscribers = self._subscribers.get(address)
+        if not subscribers:
+            return
+        subscribers.discard(server)
+        if not subscribers:
+            del self._subscribers[address]
+
+    def startup(self, loop) -> None:
+        self._loop = loop
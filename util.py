@@ -3,56 +3,148 @@
 All internal message types:
 
 NAME:           CHANNEL:                        PAYLOAD:
-User Join       {ZONE_ID}.join                  {USER_ID}
+User Join       {ZONE_ID}.join@{AGENT_INBOX}    {USER_ID}
 User Leave?     {ZONE_ID}.leave                 {USER_ID}
 User Kicked     {ZONE_ID}.kick                  {USER_ID}
-Public create   {ZONE_ID}.create.{DO_CLASS}     {SERIALIZED_DO}
+Public create   {ZONE_ID}.create.{CLASS_ID}     {SERIALIZED_DO}
 Public update   {ZONE_ID}.update                {SERIALIZED_DO}
 Public delete   {ZONE_ID}.delete                {SERIALIZED_DO}
 Public call     {ZONE_ID}.call.{DO_METHOD}      {SERIALIZED_ARGUMENTS}
-Whisper         {USER_ID}.*                     (same as public)
+Batch           {ZONE_ID}.batch                 {ENCODED_BATCH}
+Join snapshot   {USER_ID}.snapshot              {ENCODED_SNAPSHOT}
+Interest done   {USER_ID}.complete              {ZONE_ID}
+Zone hand-off   {NEW_ZONE_ID}.enter.{CLASS_ID}  {ENCODED_ENTER}
+Whisper         {USER_ID}.*  (on AGENT_INBOX)   (same as public)
 Custom          {WHATEVER}                      {WHATEVER}
 
+Calls aren't in the frame format yet (it has room for a class id, not a
+method name), so framing one raises protocol.ProtocolError.
+
 Note that Zone IDs are serialized in the DO anyway, so the duplication of the
 ZONE_ID in the channel serves entirely as an internal message pruning system.
+Updates and deletes go to the zone listeners last saw the object in. When an
+object moves to another zone, an `enter` follows on the new one. The zone
+server owning the new zone takes the object over, and agents pass it on as
+a create to the clients watching it that weren't watching the old zone.
+
+Internally every message is published on the exact address of one channel,
+never a pattern: the zone id for public messages, or the inbox of the agent
+holding the user for whispers. Each agent has one inbox and routes whispers
+to its clients by user id. Zones learn a user's inbox from the `@` part of
+the join channel. The channel name itself travels in front of the payload
+(see Channel.pack).
 """
-# TODO: Should we mark the whispers specially, since they are unique?
-# TODO: Method should be an Enum
+import struct
+from enum import IntEnum
+
 # TODO: There are subscribe/unsubscribe on the client. Change to join/leave?
 # TODO: Add a kick internal message that kicks the USER_ID in question. Ouch.
 # TODO: Add an authenticate message for the client
 
 
+class Method(IntEnum):
+    """Numeric codes for the channel methods, as sent over the wire."""
+    JOIN = 1
+    LEAVE = 2
+    KICK = 3
+    CREATE = 4
+    UPDATE = 5
+    DELETE = 6
+    CALL = 7
+    BATCH = 8
+    SNAPSHOT = 9
+    COMPLETE = 10
+    ENTER = 11
+
+    @classmethod
+    def from_name(cls, name: str) -> "Method":
+        return cls[name.upper()]
+
+    def __str__(self):
+        return self.name.lower()
+
+
 class Channel:
     """A classy representation of channels. This makes it easier
     to route messages cleanly.
+
+    Channels are built for every message, so they're slotted and cache their
+    string and encoded forms. Don't change one after it's been sent.
     """
-    def __init__(self, *, target: str=None, method=None, code_name=None):
+    __slots__ = ('target', 'method', 'code_name', 'inbox', 'reply_to',
+                 '_name', '_encoded')
+
+    _LENGTH = struct.Struct("!H")
+
+    def __init__(self, *, target: str=None, method=None, code_name=None,
+                 inbox: str=None, reply_to: str=None):
         """
         target: Either the zone or the user ID.
         method: Used to determine what is taking place
-        code_name: Only used in "create" channels (to pick a class
-           from the registry) and in "call" channels (to pick the method that
+        code_name: Only used in "create" channels (the numeric registry id
+           of the class) and in "call" channels (to pick the method that
            should be executed)
+        inbox: For whispers, the inbox of the agent the user is connected
+           to. The message is published there instead of on the target.
+        reply_to: On joins, the inbox whispers to the joining user go to.
         """
         # TODO: code_name should be named something else
         self.target = target
         self.method = method
         self.code_name = code_name
-        if self.code_name and self.method not in ["create", "call"]:
-            raise TypeError("code_name only used on `create` and `call`")
+        self.inbox = inbox
+        self.reply_to = reply_to
+        self._name = None
+        self._encoded = None
+        if self.code_name and self.method not in ["create", "call", "enter"]:
+            raise TypeError(
+                "code_name only used on `create`, `call` and `enter`")
+
+    @property
+    def address(self) -> str:
+        """The exact internal channel this message is published on."""
+        return self.inbox or self.target
 
     @staticmethod
     def parse(channel_expression: str):
         """Parses the channel name into a usable description."""
+        channel_expression, _, reply_to = channel_expression.partition('@')
         target, method, *rest = channel_expression.split('.')
         code = None
         if rest:
             code = rest[0]
-        return Channel(target=target, method=method, code_name=code)
+        return Channel(target=target, method=method, code_name=code,
+                       reply_to=reply_to or None)
+
+    def encode(self) -> bytes:
+        """The channel name, including any reply_to, as utf8."""
+        if self._encoded is None:
+            name = str(self)
+            if self.reply_to:
+                name += "@" + self.reply_to
+            self._encoded = name.encode('utf8')
+        return self._encoded
+
+    def pack(self, payload: bytes) -> bytes:
+        """Put the encoded channel name in front of a payload, for transports
+        that only carry bytes.
+        """
+        name = self.encode()
+        return b"".join((self._LENGTH.pack(len(name)), name, payload))
+
+    @classmethod
+    def unpack(cls, data: bytes) -> tuple:
+        """Split packed data back into its Channel and payload."""
+        (length,) = cls._LENGTH.unpack_from(data)
+        end = cls._LENGTH.size + length
+        channel = cls.parse(str(memoryview(data)[cls._LENGTH.size:end],
+                                'utf8'))
+        return channel, data[end:]
 
     def __str__(self):
-        pieces = [self.target, self.method]
-        if self.code_name:
-            pieces.append(self.code_name)
-        return ".".join(pieces)
+        if self._name is None:
+            pieces = [self.target, self.method]
+            if self.code_name:
+                pieces.append(self.code_name)
+            self._name = ".".join(pieces)
+        return self._name
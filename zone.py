@@ -1,22 +1,83 @@
 # coding=utf-8
 """The Zone server handles the logic for a specific vertical of gameplay."""
-import json
+import asyncio
+import os
+from collections import OrderedDict, defaultdict
 from typing import List
 
 from base import InternalMessagingServer
 from distributed_objects import DistributedObjectState, DistributedObject
+from checkpoint import CheckpointReader, write_checkpoint
+from indexes import UniqueError
+from interest import EarlyUpdates
+from persistence import SQLiteStore
+from protocol import decode_batch, decode_enter, encode_batch, \
+    encode_enter, encode_snapshot
+from schema import peek_id
 from util import Channel
 
 
 class PastryZone(InternalMessagingServer):
     """Persists state, makes changes to the state, and broadcasts the state so
     it gets to the right people.
+
+    Set tick_rate (in Hz) to coalesce changes: save() then only records what
+    changed, and every tick the changes are merged per object and sent as
+    one batch message per zone.
+
+    Joining clients share one encoded snapshot of the state. Each object's
+    create payload is kept until the object changes, and the snapshot itself
+    is only rebuilt once something has changed since it was last sent.
+
+    Set stream_joins to send very large zones a chunk at a time instead,
+    most important objects first (see join_priority), giving the rest of the
+    zone a turn on the event loop between chunks.
+
+    A zone server can also own the cells of an interest.Grid: list their zone
+    ids in cells. Joining a cell gets just the objects in it, while joining
+    zone_id gets every object that isn't in one of the cells. Objects that
+    move out of all of them are handed to the zone server owning their new
+    zone (see interest.py).
+
+    Set database to a SQLite file to keep objects with db fields across
+    restarts. Saving only marks them dirty; they're written in batches
+    every persist_interval seconds on a worker thread, and loaded back in
+    the background at startup.
+
+    Set checkpoint_path to also write the whole state to a file every
+    checkpoint_interval seconds and on shutdown, and restore it on startup.
+    The zone's encoded copies of its objects are handed to a worker thread
+    to write, so ticks carry on meanwhile. On startup the checkpoint is
+    restored first, then the database's db fields are laid over it. A
+    damaged checkpoint is restored as far as it can be read and kept aside
+    as checkpoint_path + ".damaged"; if loading fails, no checkpoint is
+    written over the old one.
     """
     registry = None
     zone_id = ""
+    tick_rate = None
+    # A tick's messages for a zone go out in batches of about this many
+    # bytes, so each fits in a client frame
+    batch_chunk_size = 256 * 1024
+    cells = ()
+    # Updates for objects we don't have are kept this many seconds, in case
+    # the object is still entering from another zone server
+    early_update_timeout = 5.0
+
+    # Joining clients get the zone's state in snapshot messages of about this
+    # many bytes, compressed unless turned off here.
+    snapshot_chunk_size = 256 * 1024
+    compress_snapshots = True
+    # Streamed joins send this many objects per chunk
+    stream_joins = False
+    stream_chunk_objects = 500
+    database = None
+    persist_interval = 1.0
+    checkpoint_path = None
+    checkpoint_interval = 60.0
 
-    def __init__(self, loop=None):
-        super().__init__(loop=loop)
+    def __init__(self, loop=None, transport=None):
+        super().__init__(loop=loop, transport=transport)
 
         # Check that registry is set up
         if not self.registry:
@@ -26,6 +87,32 @@ class PastryZone(InternalMessagingServer):
         if not self.zone_id:
             raise AttributeError("Must have a zone_id on the zone server")
         self.internal_subscribe(self.zone_id)
+        self._cells = frozenset(self.cells)
+        for cell in self._cells:
+            self.internal_subscribe(cell)
+        self._early = EarlyUpdates(self.early_update_timeout)
+        # The agent inbox each joined user's whispers go through
+        self.inboxes = {}
+        self._joined = defaultdict(set)  # user id -> zones they've joined
+        # In tick mode: object id -> [object, method, changed field names,
+        # the zone listeners last saw it in]
+        self._pending = OrderedDict()
+        self._ticker = None
+        # Object id -> (class id, create payload), for the join snapshot
+        self._encoded = {}
+        self._snapshot_version = 0
+        # zone -> (version it was built at, chunks)
+        self._snapshots = {}
+        # (user id, zone) -> task streaming the state to them
+        self._streams = {}
+        self.store = None
+        if self.database:
+            self.store = SQLiteStore(self.database, self.zone_id,
+                                     self.registry)
+        self._loading = None
+        self._persister = None
+        self._checkpointer = None
+        self._checkpoint_write = None  # The write in progress, if any
 
         # Set up the object state tracking
         self.objects = DistributedObjectState(
@@ -47,9 +134,25 @@ class PastryZone(InternalMessagingServer):
             else:
                 method = "create"
 
+            # Updates and deletes go where listeners last saw the object
+            from_zone = o._saved_field_data.get('zone', o.zone)
+
             # Build the channel
-            c = Channel(target=o.zone, method=method,
-                        code_name=None if o.created else o.__class__.__name__)
+            c = Channel(target=o.zone if method == "create" else from_zone,
+                        method=method,
+                        code_name=None if o.created else str(
+                            self.registry.class_id(o.__class__)))
+
+            # Writes that didn't change anything aren't worth sending
+            if method == "update" and not o.changed_fields():
+                o._save()
+                continue
+            # A unique clash must stop the update before anyone hears of it
+            if method == "update":
+                o._check(o._dirty_field_data)
+            self._invalidate(o.id)
+            if self.store and o._db_fields:
+                self.store.mark(o, deleted=method == "delete")
 
             # Add it locally immediately
             if method == "create":
@@ -59,11 +162,392 @@ class PastryZone(InternalMessagingServer):
             if method == "delete":
                 self.objects.delete(o.id)
 
+            if self.tick_rate:
+                # Wait for the next tick to send anything
+                self._mark_pending(o, method, from_zone)
+                o._save()
+                continue
             # Send via the network
             self.internal_broadcast(c, o.serialize(
                 for_create=method == "create"))
             # Move the dirty data over to the clean data
             o._save()
+            if method == "update" and o.zone != from_zone:
+                self._enter(o, from_zone)
+
+    def _mark_pending(self, o: DistributedObject, method: str,
+                      from_zone: str):
+        pending = self._pending.get(o.id)
+        if method == "create":
+            self._pending[o.id] = [o, method, None, None]
+        elif method == "update":
+            if pending is None:
+                self._pending[o.id] = [
+                    o, method, set(o.changed_fields()), from_zone]
+            elif pending[1] == "update":
+                pending[2].update(o.changed_fields())
+            # A pending create already sends the newest values
+        elif pending is not None and pending[1] == "create":
+            # Created and deleted within one tick; nobody needs to know
+            del self._pending[o.id]
+        else:
+            # Listeners haven't heard of any pending move yet
+            self._pending[o.id] = [
+                o, method, None, pending[3] if pending else from_zone]
+            self._pending.move_to_end(o.id)
+
+    def flush(self):
+        """Send everything saved since the last flush, one batch per zone."""
+        if not self._pending:
+            return
+        batches = defaultdict(list)
+        moved = []
+        for o, method, fields, from_zone in self._pending.values():
+            if method == "create":
+                zone = o.zone
+                c = Channel(target=zone, method=method, code_name=str(
+                    self.registry.class_id(o.__class__)))
+                payload = o.serialize(for_create=True)
+            else:
+                zone = from_zone
+                c = Channel(target=zone, method=method)
+                payload = o.serialize_fields(fields or ())
+                if method == "update" and o.zone != from_zone:
+                    moved.append((o, from_zone))
+            batches[zone].append((c, payload))
+        self._pending.clear()
+
+        for zone, messages in batches.items():
+            for batch in encode_batch(messages, self.batch_chunk_size):
+                self.internal_broadcast(
+                    Channel(target=zone, method="batch"), batch)
+        for o, from_zone in moved:
+            self._enter(o, from_zone)
+
+    def _enter(self, o: DistributedObject, from_zone: str):
+        """Introduce an object to the zone it just moved into, then forget
+        it unless that zone is ours too. The update moving it has already
+        gone to from_zone.
+        """
+        # Anything still waiting for a tick must reach from_zone first
+        pending = self._pending.pop(o.id, None)
+        if pending is not None and pending[1] == "update":
+            self.internal_broadcast(
+                Channel(target=pending[3], method="update"),
+                o.serialize_fields(pending[2]))
+        class_id, payload = self._encode(o)
+        self.internal_broadcast(
+            Channel(target=o.zone, method="enter", code_name=str(class_id)),
+            encode_enter(from_zone, payload))
+        if o.zone == self.zone_id or o.zone in self._cells:
+            return
+        self._invalidate(o.id)
+        if self.store and o._db_fields:
+            self.store.mark(o, deleted=True)
+        self._early.left(from_zone, o.id, self._loop.time())
+        self.objects.delete(o.id)
+
+    def _refuse(self, o: DistributedObject, data: dict, exc: UniqueError):
+        """Turn down a client's change that broke a unique index. Clients
+        may have applied it already, so they're sent the object's real
+        values (or a delete, if it was never created) along with the values
+        of the objects it clashed with.
+        """
+        self.log("Refusing a change to {}: {}".format(o.id, exc))
+        if self.objects.get(o.id) is not o:
+            self.internal_broadcast(Channel(target=o.zone, method="delete"),
+                                    o.serialize_fields(()))
+            others = self.objects.clashes(o, data)
+        else:
+            others = [o] + self.objects.clashes(o, data)
+        for other in others:
+            names = [n for n in data if n in other._fields]
+            self.internal_broadcast(Channel(target=other.zone,
+                                            method="update"),
+                                    other.serialize_fields(names))
+
+    def queue_depth(self) -> int:
+        return super().queue_depth() + len(self._pending)
+
+    async def _tick(self):
+        period = 1 / self.tick_rate
+        next_tick = self._loop.time()
+        while True:
+            next_tick += period
+            await asyncio.sleep(max(0, next_tick - self._loop.time()))
+            self.flush()
+
+    def startup(self):
+        super().startup()
+        if self.tick_rate:
+            self._ticker = asyncio.ensure_future(self._tick(), loop=self._loop)
+        if self.store or self.checkpoint_path:
+            self._loading = asyncio.ensure_future(
+                self._load(), loop=self._loop)
+        if self.store:
+            self._persister = asyncio.ensure_future(
+                self._persist(), loop=self._loop)
+        if self.checkpoint_path:
+            self._checkpointer = asyncio.ensure_future(
+                self._checkpoint_regularly(), loop=self._loop)
+
+    def shutdown(self):
+        for task in self._streams.values():
+            task.cancel()
+        if self._ticker:
+            self._ticker.cancel()
+            self.flush()
+        if self._loading:
+            self._loading.cancel()
+        if self.store:
+            self._persister.cancel()
+            write = self.store.close()
+            if write is not None:
+                self._persisted(write)
+        if self.checkpoint_path:
+            self._checkpointer.cancel()
+            if self._checkpoint_write:
+                self._loop.run_until_complete(self._checkpoint_write)
+            if self._loaded():
+                # Don't overwrite a checkpoint with part of the state
+                write_checkpoint(self.checkpoint_path,
+                                 self.registry.fingerprint,
+                                 [self._encode(o) for o in self.objects])
+        super().shutdown()
+
+    async def _load(self):
+        restored = set()
+        try:
+            if self.checkpoint_path:
+                restored = await self._restore_checkpoint()
+            if self.store:
+                await self._load_database(restored)
+        except Exception as exc:
+            self.log("Loading failed:", repr(exc))
+            raise
+
+    def _loaded(self) -> bool:
+        """Whether loading finished, so the zone holds its whole state."""
+        return self._loading.done() and not self._loading.cancelled() \
+            and self._loading.exception() is None
+
+    async def _load_database(self, restored: set):
+        """Bring back the persisted objects, a chunk at a time. Objects
+        restored from the checkpoint get their stored fields laid over them,
+        since the database is written more often. Objects that were created
+        in the meantime win over their stored copies.
+        """
+        rows = await asyncio.wrap_future(self.store.load(), loop=self._loop)
+        step = self.stream_chunk_objects
+        for start in range(0, len(rows), step):
+            for o in self.store.decode(rows[start:start + step]):
+                existing = self.objects.get(o.id)
+                if existing is None:
+                    self._invalidate(o.id)
+                    self.objects.create(o)
+                elif o.id in restored:
+                    # The row only holds these, the rest are defaults
+                    stored = ('owner', 'zone') + o._db_fields
+                    existing._update({n: o._dirty_field_data[n]
+                                      for n in stored})
+                    self._invalidate(o.id)
+            await asyncio.sleep(0)
+        self.log("Loaded {} objects from {}".format(len(rows), self.database))
+
+    async def _restore_checkpoint(self) -> set:
+        """Recreate the checkpointed objects a chunk at a time, skipping any
+        that already exist. Returns the ids of the restored objects.
+        """
+        restored = set()
+        try:
+            checkpoint = CheckpointReader(self.checkpoint_path,
+                                          self.registry.fingerprint)
+        except FileNotFoundError:
+            return restored
+        except ValueError as exc:
+            self.log("Not restoring checkpoint:", exc)
+            return restored
+        damaged = None
+        with checkpoint:
+            try:
+                for chunk in checkpoint.chunks(self.stream_chunk_objects):
+                    for class_id, payload in chunk:
+                        try:
+                            o = self.registry[class_id].deserialize(payload)
+                        except Exception as exc:
+                            damaged = exc  # Skip just this one
+                            continue
+                        if self.objects.get(o.id) is not None:
+                            continue
+                        self.objects.create(o)
+                        restored.add(o.id)
+                        # What we read is already its create payload
+                        self._encoded[o.id] = (class_id, payload)
+                    self._snapshot_version += 1
+                    await asyncio.sleep(0)
+            except ValueError as exc:  # Cut short
+                damaged = exc
+                self._snapshot_version += 1
+        if damaged is not None:
+            # Later checkpoints replace it, so keep what's left to look at
+            kept = self.checkpoint_path + ".damaged"
+            os.replace(self.checkpoint_path, kept)
+            self.log("Restored only {} of {} objects from damaged checkpoint"
+                     " {}, kept as {}: {!r}".format(
+                         len(restored), checkpoint.count,
+                         self.checkpoint_path, kept, damaged))
+            return restored
+        self.log("Restored {} objects from {}".format(
+            checkpoint.count, self.checkpoint_path))
+        return restored
+
+    async def checkpoint(self):
+        """Write the whole state to checkpoint_path without blocking ticks.
+        Only objects changed since they were last encoded are re-encoded, a
+        chunk at a time; the writing happens on a worker thread. If a write
+        is already under way, this waits for that one instead.
+        """
+        if self._checkpoint_write is None:
+            self._checkpoint_write = asyncio.ensure_future(
+                self._write_checkpoint(), loop=self._loop)
+        write = self._checkpoint_write
+        try:
+            await asyncio.shield(write)
+        finally:
+            if write.done() and self._checkpoint_write is write:
+                self._checkpoint_write = None
+
+    async def _write_checkpoint(self):
+        everything = list(self.objects)
+        objects, step = [], self.stream_chunk_objects
+        for start in range(0, len(everything), step):
+            # Skip anything deleted while we let the loop run
+            objects.extend(self._encode(o)
+                           for o in everything[start:start + step]
+                           if self.objects.get(o.id) is o)
+            await asyncio.sleep(0)
+        await self._loop.run_in_executor(
+            None, write_checkpoint, self.checkpoint_path,
+            self.registry.fingerprint, objects)
+
+    async def _checkpoint_regularly(self):
+        await asyncio.wait([self._loading])
+        if not self._loaded():
+            self.log("Not checkpointing, since loading failed")
+            return
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+            except Exception as exc:
+                self.log("Checkpoint failed:", repr(exc))
+
+    async def _persist(self):
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            write = self.store.flush()
+            if write is not None:
+                asyncio.wrap_future(write, loop=self._loop) \
+                    .add_done_callback(self._persisted)
+
+    def _persisted(self, write):
+        """Report a failed database write. The store tries it again."""
+        if not write.cancelled() and write.exception() is not None:
+            self.log("Couldn't write to {}: {!r}".format(
+                self.database, write.exception()))
+
+    def _invalidate(self, obj_id: str):
+        """Forget the encoded copy of an object that has changed."""
+        self._encoded.pop(obj_id, None)
+        self._snapshot_version += 1
+
+    def _zone_objects(self, zone: str) -> list:
+        """The objects a client joining zone should get."""
+        if zone in self._cells:
+            return self.objects.filter(zone=zone)
+        if not self._cells:
+            return list(self.objects)
+        return [o for o in self.objects if o.zone not in self._cells]
+
+    def _snapshot_chunks(self, zone: str) -> list:
+        """The encoded join snapshot, rebuilt only if the state changed.
+        Only the objects that changed since the last build are re-serialized.
+        """
+        version, chunks = self._snapshots.get(zone, (None, None))
+        if version == self._snapshot_version:
+            return chunks
+        chunks = encode_snapshot(map(self._encode, self._zone_objects(zone)),
+                                 self.snapshot_chunk_size,
+                                 self.compress_snapshots)
+        self._snapshots[zone] = (self._snapshot_version, chunks)
+        return chunks
+
+    def _encode(self, o: DistributedObject) -> tuple:
+        """An object's class id and create payload, encoded at most once
+        per change.
+        """
+        entry = self._encoded.get(o.id)
+        if entry is None:
+            entry = self._encoded[o.id] = (
+                self.registry.class_id(o.__class__),
+                o.serialize(for_create=True))
+        return entry
+
+    def _sync(self, user_id: str, zone: str):
+        """Whisper a zone's state to a user as snapshot messages, then mark
+        their interest in it complete.
+        """
+        if self.stream_joins:
+            self._stop_stream(user_id, zone)
+            self._streams[user_id, zone] = asyncio.ensure_future(
+                self._stream(user_id, zone), loop=self._loop)
+            return
+        for chunk in self._snapshot_chunks(zone):
+            self._whisper(user_id, "snapshot", chunk)
+        self._whisper(user_id, "complete", zone.encode('utf8'))
+
+    async def _stream(self, user_id: str, zone: str):
+        """Send the zone state in chunks, in join_priority order. Each chunk
+        is encoded just before it goes out, so objects that changed while
+        waiting are sent as they are now and deleted ones are skipped.
+        """
+        try:
+            ordered = sorted(self._zone_objects(zone),
+                             key=lambda o: self.join_priority(user_id, o))
+            step = self.stream_chunk_objects
+            for start in range(0, len(ordered), step):
+                objects = [self._encode(o) for o in ordered[start:start + step]
+                           if self.objects.get(o.id) is o]
+                for chunk in encode_snapshot(objects, self.snapshot_chunk_size,
+                                             self.compress_snapshots):
+                    self._whisper(user_id, "snapshot", chunk)
+                # Let live updates and other joins through
+                await asyncio.sleep(0)
+            self._whisper(user_id, "complete", zone.encode('utf8'))
+        finally:
+            if self._streams.get((user_id, zone)) is asyncio.current_task():
+                del self._streams[user_id, zone]
+
+    def _late_sync(self, user_id: str, zone: str):
+        """Sync a user who joined while we were loading, if still there."""
+        if zone in self._joined.get(user_id, ()):
+            self._sync(user_id, zone)
+
+    def _stop_stream(self, user_id: str, zone: str):
+        task = self._streams.pop((user_id, zone), None)
+        if task:
+            task.cancel()
+
+    def _whisper(self, user_id: str, method: str, message: bytes):
+        self.internal_broadcast(Channel(target=user_id, method=method,
+                                        inbox=self.inboxes[user_id]), message)
+
+    def join_priority(self, user_id: str, obj: DistributedObject):
+        """Sort key for streamed joins; objects with lower keys are sent
+        first. Override this to send, say, whatever is near the user's avatar
+        first.
+        """
+        return 0
 
     def setup(self):
         pass
@@ -92,30 +576,94 @@ class PastryZone(InternalMessagingServer):
         self.log("Received", channel)
 
         if channel.method == "create":
-            kwargs = json.loads(message)
             class_ = self.registry[channel.code_name]
-            self.objects.create(class_(**kwargs))
+            obj = class_.deserialize(message)
+            existing = self.objects.get(obj.id)
+            try:
+                self.objects.create(obj)
+            except UniqueError as exc:
+                self._refuse(existing or obj, obj._dirty_field_data, exc)
+                return
+            self._invalidate(obj.id)
+            if self.store and obj._db_fields:
+                self.store.mark(self.objects[obj.id])
 
         elif channel.method == "update":
-            kwargs = json.loads(message)
-            self.objects.update(**kwargs)
+            obj = self.objects.get(peek_id(message))
+            if obj is None:
+                # It may still be entering from another zone server
+                expired = self._early.hold(channel.target, peek_id(message),
+                                           message, self._loop.time())
+                for zone, obj_id in expired:
+                    self.log("Dropped updates for {}, which never entered "
+                             "{}".format(obj_id, zone))
+                return
+            from_zone = obj.zone
+            try:
+                self.objects.apply_update(message)
+            except UniqueError as exc:
+                self._refuse(obj, obj._schema.decode(message), exc)
+                return
+            self._invalidate(obj.id)
+            if self.store and obj._db_fields:
+                self.store.mark(obj)
+            # A client moved it; introduce it to its new zone
+            if obj.zone != from_zone:
+                self._enter(obj, from_zone)
+
+        elif channel.method == "enter":
+            # Another zone server is handing an object over to us
+            payload = decode_enter(message)[1]
+            if self.objects.get(peek_id(payload)) is not None:
+                # We moved it here ourselves, and our copy is as new
+                return
+            obj = self.registry[channel.code_name].deserialize(payload)
+            try:
+                self.objects.create(obj)
+            except UniqueError as exc:
+                self.log("Couldn't take over {}: {}".format(obj.id, exc))
+                return
+            self._invalidate(obj.id)
+            if self.store and obj._db_fields:
+                self.store.mark(obj)
+            # The mover's updates that beat the enter here
+            update = Channel(target=channel.target, method="update")
+            for m in self._early.take(channel.target, obj.id):
+                self._handle_internal_message(update, m)
+
+        elif channel.method == "batch":
+            for c, m in decode_batch(channel, message):
+                self._handle_internal_message(c, m)
         # TODO: Delete, Call
 
         elif channel.method == "join":
-            # Someone just joined!
-            self.client_connected(message)
-
-            # Let's also sync down our zone's state.
-            self.log("{} joined. Syncing server state ({} objects)".format(
-                message, len(self.objects)))
-            for o in self.objects:
-                output_channel = Channel(
-                    # The message here is the user's ID.
-                    target=message, method="create",
-                    code_name=o.__class__.__name__)
-                self.internal_broadcast(
-                    output_channel, o.serialize(for_create=True))
+            # Someone just joined! The message here is the user's ID.
+            user_id = message.decode('utf8')
+            first_join = user_id not in self.inboxes
+            self.inboxes[user_id] = channel.reply_to
+            self._joined[user_id].add(channel.target)
+            if first_join:
+                self.client_connected(user_id)
+
+            # Let's also sync down our zone's state, once it's all loaded
+            self.log("{} joined {}. Syncing server state".format(
+                user_id, channel.target))
+            if self._loading and not self._loading.done():
+                zone = channel.target
+                self._loading.add_done_callback(
+                    lambda _: self._late_sync(user_id, zone))
+            else:
+                self._sync(user_id, channel.target)
 
         elif channel.method == "leave":
             # Someone just left!
-            self.client_disconnected(message)
+            user_id = message.decode('utf8')
+            self._stop_stream(user_id, channel.target)
+            zones = self._joined.get(user_id)
+            if zones:
+                zones.discard(channel.target)
+            if not zones:
+                # That was the last of our zones they were in
+                self._joined.pop(user_id, None)
+                self.inboxes.pop(user_id, None)
+                self.client_disconnected(user_id)